@@ -0,0 +1,147 @@
+import asyncio
+from itertools import count
+
+from db_protocol import encode_message, read_message, ProtocolError
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.pending: dict[int, asyncio.Future] = {}
+        self.write_lock = asyncio.Lock()
+        self.closed = False
+        self.task = asyncio.create_task(self._read_replies())
+
+    async def _read_replies(self):
+        # Replies are matched to requests by id. Frames of a streamed reply
+        # are collected until its end frame arrives.
+        streams = {}
+        error = ProtocolError("Connection closed by server.")
+        try:
+            while (frame := await read_message(self.reader)) is not None:
+                request_id = frame.pop("id", None)
+                if request_id is None:
+                    if "error" in frame:
+                        error = ProtocolError(frame["error"])
+                        break
+                    continue
+                if frame.pop("stream", False):
+                    streams[request_id] = (frame, [])
+                    continue
+                if request_id in streams:
+                    if "chunk" in frame:
+                        streams[request_id][1].extend(frame["chunk"])
+                        continue
+                    header, rows = streams.pop(request_id)
+                    if "error" not in frame:
+                        header["rows"] = rows
+                        frame = header
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except (OSError, ProtocolError, ValueError) as e:
+            error = e
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+            self.writer.close()
+
+
+class AsyncDbClient:
+    # Multiplexes any number of outstanding requests over a few connections.
+    # Each request is tagged with an id and the server may answer them in
+    # any order. A connection that was closed is reopened on next use.
+
+    def __init__(self, host='127.0.0.1', port=9001, connections=2, timeout=None, encoding='json', compression=None) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.encoding = encoding
+        self.compression = compression
+        self.connections: list[_Connection | None] = [None] * connections
+        self._ids = count()
+        self._next = 0
+        self._connect_lock = None
+
+    async def run(self):
+        for index in range(len(self.connections)):
+            await self._connection(index)
+
+    async def close(self):
+        connections, self.connections = self.connections, [None] * len(self.connections)
+        for connection in connections:
+            if connection is not None:
+                connection.writer.close()
+                await asyncio.gather(connection.task, return_exceptions=True)
+
+    async def request(self, action, data):
+        index = self._next
+        self._next = (self._next + 1) % len(self.connections)
+        return await self._send(await self._connection(index), action, data)
+
+    async def _send(self, connection: _Connection, action, data):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        connection.pending[request_id] = future
+        try:
+            async with connection.write_lock:
+                connection.writer.write(encode_message({"id": request_id, "action": action, "data": data}))
+                await connection.writer.drain()
+            response = await asyncio.wait_for(future, self.timeout)
+        finally:
+            connection.pending.pop(request_id, None)
+        return response
+
+    async def _connection(self, index):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            connection = self.connections[index]
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                connection = self.connections[index] = _Connection(reader, writer)
+                if self.encoding != 'json' or self.compression:
+                    await self._send(connection, "hello", {"encodings": [self.encoding, 'json'], "compression": self.compression})
+            return connection
+
+    async def ping(self):
+        return await self.request("ping", {})
+
+    async def stats(self):
+        response = await self.request("stats", {})
+        return response["metrics"]
+
+    async def insert_row(self, db_name, table_name, values, durability=None):
+        return await self.request("insert_row", {"db_name": db_name, "table_name": table_name, "values": values, "durability": durability})
+
+    async def insert_rows(self, db_name, table_name, rows, durability=None):
+        return await self.request("insert_rows", {"db_name": db_name, "table_name": table_name, "rows": rows, "durability": durability})
+
+    async def update_row(self, db_name, table_name, _id, values, durability=None):
+        return await self.request("update_row", {"db_name": db_name, "table_name": table_name, "values": values, "_id": _id, "durability": durability})
+
+    async def update_rows(self, db_name, table_name, updates: dict, durability=None):
+        return await self.request("update_rows", {"db_name": db_name, "table_name": table_name, "updates": updates, "durability": durability})
+
+    async def delete_row(self, db_name, table_name, _id, durability=None):
+        return await self.request("delete_row", {"db_name": db_name, "table_name": table_name, "_id": _id, "durability": durability})
+
+    async def delete_rows(self, db_name, table_name, ids, durability=None):
+        return await self.request("delete_rows", {"db_name": db_name, "table_name": table_name, "ids": ids, "durability": durability})
+
+    async def query(self, db_name, table_name, columns=None, where=None, order_by=None, limit=None):
+        query = {"columns": columns, "where": where, "order_by": order_by, "limit": limit}
+        response = await self.request("query", {"db_name": db_name, "table_name": table_name, "query": query})
+        return response["columns"], response["rows"]
+
+    async def fetch_databases_and_tables(self):
+        response = await self.request("fetch_databases_and_tables", {})
+        return response['databases']
+
+    async def get_table_page(self, db_name, table_name, offset=0, limit=None, cursor=None):
+        response = await self.request("get_table_data", {"db_name": db_name, "table_name": table_name, "offset": offset, "limit": limit, "cursor": cursor})
+        return response["types"], response["columns"], {row[0]: row[1:] for row in response["rows"]}, response["cursor"]
@@ -0,0 +1,156 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from server import DbServer
+from db_protocol import encode_message, read_frame, ProtocolError
+
+
+class AsyncDbServer(DbServer):
+    # Same actions as DbServer, served from one event loop. Requests run on a
+    # bounded thread pool, since the manager blocks on disk and on its locks.
+    # A client may pipeline requests: each one tagged with an "id" is served
+    # as soon as it arrives and its reply carries the same id, so replies can
+    # come back out of order.
+
+    def __init__(self, max_connections=1000, workers=8, max_pipeline=32) -> None:
+        super().__init__()
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.connections = 0
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.connections >= self.max_connections:
+            writer.write(encode_message({"error": "Too many connections"}))
+            await self._close(writer)
+            return
+
+        self.connections += 1
+        self.metrics.connection_opened('socket')
+        write_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(self.max_pipeline)
+        tasks = set()
+        feeds = set()
+        session = {"encoding": 'json', "compression": None}
+
+        def done(task):
+            tasks.discard(task)
+            in_flight.release()
+
+        try:
+            while (frame := await read_frame(reader)) is not None:
+                request_data = self.decode_request(frame)
+                if request_data.get("action") == "hello":
+                    try:
+                        reply = self.handshake(request_data.get("data"))
+                    except ValueError as e:
+                        reply = {"error": str(e)}
+                    if "id" in request_data:
+                        reply["id"] = request_data["id"]
+                    async with write_lock:
+                        writer.write(encode_message(reply, session["compression"]))
+                        await writer.drain()
+                    if "error" not in reply:
+                        session = {"encoding": reply["encoding"], "compression": reply["compression"]}
+                    continue
+                if request_data.get("action") == "subscribe":
+                    # Change events share the connection with other replies
+                    # and keep coming until the client disconnects.
+                    feeds.add(asyncio.create_task(self._push_changes(request_data, writer, write_lock, session["compression"])))
+                    continue
+                await in_flight.acquire()
+                task = asyncio.create_task(self._serve(request_data, writer, write_lock, dict(session)))
+                tasks.add(task)
+                task.add_done_callback(done)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ProtocolError, ConnectionError, ValueError):
+            for task in tasks:
+                task.cancel()
+        finally:
+            for feed in feeds:
+                feed.cancel()
+            await asyncio.gather(*feeds, return_exceptions=True)
+            self.connections -= 1
+            self.metrics.connection_closed('socket')
+            await self._close(writer)
+
+    async def _serve(self, request_data: dict, writer: asyncio.StreamWriter, write_lock: asyncio.Lock, session: dict):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        tag = {"id": request_data["id"]} if "id" in request_data else {}
+        tally = {}
+        try:
+            frames = await loop.run_in_executor(self.executor, self.respond, request_data, session)
+        except Exception as e:
+            frames = [{**tag, "error": str(e)}]
+
+        # Frames of one reply are written back to back, so a streamed result
+        # is never interleaved with another reply on the same connection.
+        # Streamed rows are rendered and encoded as frames are pulled, so
+        # each frame is produced on the pool and never on the event loop.
+        encoded = self.encoded_frames(frames, session["compression"], tally)
+        async with write_lock:
+            try:
+                while True:
+                    data = await loop.run_in_executor(self.executor, next, encoded, None)
+                    if data is None:
+                        break
+                    writer.write(data)
+                    await writer.drain()
+            except ConnectionError:
+                pass
+            except Exception as e:
+                tally["error"] = str(e)
+                writer.write(encode_message({**tag, "error": str(e)}))
+                await writer.drain()
+        self.record(request_data, time.perf_counter() - start, tally)
+
+    async def _push_changes(self, request_data: dict, writer: asyncio.StreamWriter, write_lock: asyncio.Lock, compression):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        data = request_data.get("data") or {}
+        tag = {"id": request_data["id"]} if "id" in request_data else {}
+        subscription = self.dbm.feed.subscribe(
+            data.get("db_name", None), data.get("table_name", None),
+            notify=lambda: loop.call_soon_threadsafe(wakeup.set),
+        )
+        try:
+            async with write_lock:
+                writer.write(encode_message({**tag, "status": "subscribed"}, compression))
+                await writer.drain()
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                while (event := subscription.get_nowait()) is not None:
+                    async with write_lock:
+                        writer.write(encode_message({**tag, **event}, compression))
+                        await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            subscription.close()
+
+    async def _close(self, writer: asyncio.StreamWriter):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.dbm.load, self.load_mode)
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=self.max_connections)
+        print(f"Server is listening on port {self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def start_server(self):
+        asyncio.run(self.serve())
+
+
+if __name__ == "__main__":
+    server = AsyncDbServer()
+    server.start_server()
@@ -0,0 +1,277 @@
+import gc
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+from datetime import date, datetime
+
+from db_manager import DbManager
+from server import DbServer
+from client import DbClient
+
+
+# One column of every type a table can hold.
+COLUMNS = 'number:INT,score:REAL,grade:CHAR,name:STRING,born:DATE,stay:DATEINVL'
+SIZES = (10_000, 100_000, 1_000_000)
+SUITES = ('engine', 'socket', 'api')
+# Single-row operations are timed over this many calls, not the whole table.
+SINGLE_OPS = 200
+PAGE_ROWS = 1000
+QUERY = {"where": {"column": "grade", "op": "=", "value": "A"}, "order_by": ["number"], "limit": 100}
+# A result this much slower than the baseline counts as a regression.
+THRESHOLD = 0.10
+SEED = 42
+
+
+def make_rows(count, seed=SEED):
+    # The same rows for the same count and seed. Every tenth row repeats an
+    # earlier one, so delete_repeated has work to do.
+    rnd = random.Random(seed)
+    first_day = date(1970, 1, 1).toordinal()
+    rows = []
+    for i in range(count):
+        if i % 10 == 9:
+            rows.append(list(rows[rnd.randrange(i - 1)]))
+            continue
+        born = first_day + rnd.randrange(20000)
+        start = born + rnd.randrange(1000)
+        rows.append([
+            str(rnd.randrange(-10 ** 6, 10 ** 6)),
+            str(round(rnd.uniform(0, 100), 3)),
+            rnd.choice('ABCDEF'),
+            f'name-{rnd.randrange(count)}',
+            date.fromordinal(born).strftime('%Y.%m.%d'),
+            f"{date.fromordinal(start).strftime('%Y.%m.%d')}-{date.fromordinal(start + 1 + rnd.randrange(365)).strftime('%Y.%m.%d')}",
+        ])
+    return rows
+
+
+class Recorder:
+    def __init__(self, repeat=3) -> None:
+        self.repeat = repeat
+        self.results = {}
+
+    def time(self, name, fn, ops=1, repeat=None, setup=None):
+        # Best of `repeat` runs, with the collector off so it does not land
+        # in a random run. setup, if given, runs untimed before each one.
+        best = None
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            best = elapsed if best is None else min(best, elapsed)
+        self.results[name] = {"seconds": best, "ops": ops, "ops_per_sec": ops / best if best else None}
+        print(f"{name:<48} {best * 1000:>12.2f} ms {ops / best if best else 0:>14.0f} ops/s", file=sys.stderr)
+
+
+def bench_engine(recorder: Recorder, folder, size, rows, storage, durability):
+    prefix = f'engine/{size}'
+    dbm = DbManager(folder, durability=durability)
+    table = f'bench_{size}'
+    dbm.create_table('bench', table, COLUMNS, storage)
+
+    def reset():
+        dbm.delete_table('bench', table)
+        dbm.create_table('bench', table, COLUMNS, storage)
+
+    recorder.time(f'{prefix}/insert_rows', lambda: dbm.insert_rows('bench', table, rows), len(rows), setup=reset)
+    ids = [key for key, _ in dbm.databases['bench'].tables[table].snapshot()]
+
+    singles = rows[:SINGLE_OPS]
+    recorder.time(f'{prefix}/insert_row', lambda: [dbm.insert_row('bench', table, row) for row in singles], len(singles), repeat=1)
+    targets = ids[:SINGLE_OPS]
+    recorder.time(
+        f'{prefix}/update_row',
+        lambda: [dbm.update_row('bench', table, _id, row) for _id, row in zip(targets, reversed(singles))],
+        len(targets), repeat=1,
+    )
+    updates = dict(zip(ids[:len(ids) // 10], rows))
+    recorder.time(f'{prefix}/update_rows', lambda: dbm.update_rows('bench', table, updates), len(updates))
+    recorder.time(f'{prefix}/get_table_data', lambda: dbm.get_table_data('bench', table), len(ids))
+    recorder.time(f'{prefix}/get_table_page', lambda: dbm.get_table_page('bench', table, len(ids) // 2, PAGE_ROWS), PAGE_ROWS)
+    recorder.time(f'{prefix}/query', lambda: dbm.query('bench', table, QUERY), 1)
+    dbm.compact('bench', table)
+    dbm.close()
+
+    for mode in ('eager', 'lazy'):
+        def load():
+            loaded = DbManager(folder)
+            loaded.load(mode)
+            # Lazy tables are parsed on first access, which is part of the cost.
+            len(loaded.databases['bench'].tables[table].rows)
+            loaded.close()
+        recorder.time(f'{prefix}/load_{mode}', load, len(ids) + len(singles))
+
+    dbm = DbManager(folder, durability=durability)
+    dbm.load('eager')
+    recorder.time(f'{prefix}/delete_repeated', lambda: dbm.delete_repeated('bench', table), 1, repeat=1)
+    dbm.close()
+
+
+def serve_loopback(server: DbServer):
+    # Like DbServer.start_server, on a free port and in the background.
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            try:
+                client_socket, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=server.handle_client, args=(client_socket,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def bench_socket(recorder: Recorder, folder, size, durability):
+    prefix = f'socket/{size}'
+    table = f'bench_{size}'
+    server = DbServer()
+    server.dbm = DbManager(folder, durability=durability)
+    server.dbm.load('eager')
+    listener = serve_loopback(server)
+    port = listener.getsockname()[1]
+    try:
+        for encoding in ('json', 'binary'):
+            client = DbClient(port=port, pool_size=1, encoding=encoding)
+            client.run()
+            if encoding == 'json':
+                recorder.time(f'{prefix}/ping', lambda: [client.ping() for _ in range(SINGLE_OPS)], SINGLE_OPS)
+                recorder.time(
+                    f'{prefix}/insert_row',
+                    lambda: [client.insert_row('bench', table, row) for row in make_rows(SINGLE_OPS, SEED + 1)],
+                    SINGLE_OPS, repeat=1,
+                )
+            # Every other run hits the response cache, so it is cleared to
+            # time the full path as well.
+            recorder.time(
+                f'{prefix}/get_table_data_{encoding}', lambda: client.get_table_data('bench', table), size,
+                setup=server.cache.clear,
+            )
+            recorder.time(f'{prefix}/get_table_data_{encoding}_cached', lambda: client.get_table_data('bench', table), size)
+            client.close()
+    finally:
+        listener.close()
+        server.dbm.close()
+
+
+def bench_api(recorder: Recorder, folder, size, durability):
+    try:
+        from fastapi.testclient import TestClient
+        import db_api
+    except ImportError as e:
+        print(f"Skipping the api suite: {e}", file=sys.stderr)
+        return
+    prefix = f'api/{size}'
+    table = f'bench_{size}'
+    db_api.db_manager = DbManager(folder, durability=durability)
+    with TestClient(db_api.app) as client:
+        params = {"db_name": "bench", "table_name": table}
+        recorder.time(f'{prefix}/table_data', lambda: client.get('/table_data', params=params).raise_for_status(), size)
+        recorder.time(
+            f'{prefix}/table_data_stream',
+            lambda: client.get('/table_data', params={**params, "stream": True}).raise_for_status(), size,
+        )
+        recorder.time(
+            f'{prefix}/insert_row',
+            lambda: [
+                client.post('/insert_row', json={**params, "values": row}).raise_for_status()
+                for row in make_rows(SINGLE_OPS, SEED + 2)
+            ],
+            SINGLE_OPS, repeat=1,
+        )
+        recorder.time(
+            f'{prefix}/query',
+            lambda: client.post('/query', json={**params, "query": QUERY}).raise_for_status(),
+            1,
+        )
+    db_api.db_manager.close()
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # Prints each benchmark against the baseline and returns the names of
+    # those that got slower by more than threshold.
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print(f"{name:<48} {'new':>12}", file=sys.stderr)
+            continue
+        before, after = baseline[name]["seconds"], result["seconds"]
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f"{name:<48} {before * 1000:>10.2f} ms {after * 1000:>10.2f} ms {change:>+8.1%}{flag}", file=sys.stderr)
+    return regressions
+
+
+def run(sizes=SIZES, suites=SUITES, storage='row', durability='async', repeat=3):
+    recorder = Recorder(repeat)
+    for size in sizes:
+        rows = make_rows(size)
+        with tempfile.TemporaryDirectory() as folder:
+            # The engine suite leaves its table on disk for the others.
+            bench_engine(recorder, folder, size, rows, storage, durability)
+            if 'socket' in suites:
+                bench_socket(recorder, folder, size, durability)
+            if 'api' in suites:
+                bench_api(recorder, folder, size, durability)
+    if 'engine' not in suites:
+        recorder.results = {k: v for k, v in recorder.results.items() if not k.startswith('engine/')}
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": list(sizes),
+            "storage": storage,
+            "durability": durability,
+            "repeat": repeat,
+            "seed": SEED,
+        },
+        "results": recorder.results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the engine, the socket server and the HTTP API.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help="Table sizes in rows")
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--storage', choices=('row', 'columnar'), default='row')
+    parser.add_argument('--durability', choices=('async', 'batched', 'sync'), default='async')
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, the best one is kept")
+    parser.add_argument('--output', help="Write the results as JSON to this file instead of stdout")
+    parser.add_argument('--baseline', help="Compare against results saved earlier with --output")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.suites, args.storage, args.durability, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(report["results"], baseline["results"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
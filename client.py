@@ -1,68 +1,241 @@
+import time
 import socket
-import json
+import threading
+
+from db_protocol import send_message, recv_message, recv_response, ProtocolError
+
+
+class ConnectionPool:
+    # Up to `size` connections shared by any number of threads. A connection
+    # that sat idle for longer than `health_check_interval` is pinged before
+    # it is handed out and replaced if the server no longer answers.
+
+    def __init__(self, connect, size=4, health_check_interval=30.0) -> None:
+        self.connect = connect
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.idle: list[tuple[socket.socket, float]] = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout=None):
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("No connection available.")
+        try:
+            while True:
+                with self.lock:
+                    sock, last_used = self.idle.pop() if self.idle else (None, None)
+                if sock is None:
+                    return self.connect()
+                if time.monotonic() - last_used < self.health_check_interval or self._healthy(sock):
+                    return sock
+                sock.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, sock: socket.socket, broken=False):
+        if broken:
+            sock.close()
+        else:
+            with self.lock:
+                self.idle.append((sock, time.monotonic()))
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock, _ in idle:
+            sock.close()
+
+    def _healthy(self, sock: socket.socket):
+        try:
+            send_message(sock, {"action": "ping", "data": {}})
+            return recv_response(sock).get("status") == "ok"
+        except (OSError, ProtocolError, ValueError):
+            return False
+
+
+class ChangeStream:
+    # Iterates over the change events of a subscription, each a dict with
+    # db_name, table_name, the table version after the change and a list of
+    # [op, id, values] changes, op being I, U or D. An event of
+    # {"resync": True} means events were dropped because the reader fell
+    # behind. Uses a connection of its own, outside the pool.
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+
+    def __iter__(self):
+        while (event := recv_message(self.sock)) is not None:
+            if "error" in event:
+                raise ProtocolError(event["error"])
+            yield event
+
+    def close(self):
+        # Also wakes up a thread blocked reading the stream.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class DbClient:
-    def __init__(self) -> None:
-        self.host = '127.0.0.1'
-        self.port = 9001
-        self.client = None
+    def __init__(self, host='127.0.0.1', port=9001, pool_size=4, timeout=None, encoding='json', compression=None) -> None:
+        # compression is None or a dict with a zlib "level" and a size
+        # "threshold" below which replies are sent uncompressed.
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.encoding = encoding
+        self.compression = compression
+        self.pool = ConnectionPool(self._connect, pool_size)
 
     def run(self):
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((self.host, self.port))
+        # Opens the first connection up front, so a wrong address fails here
+        # and not on the first request.
+        self.pool.release(self.pool.acquire(self.timeout))
+
+    def close(self):
+        self.pool.close()
+
+    def _connect(self):
+        return self._handshake(socket.create_connection((self.host, self.port), self.timeout))
+
+    def _handshake(self, sock: socket.socket):
+        # Replies carry their encoding and compression in the frame itself,
+        # so the negotiated settings do not have to be remembered. A server
+        # that does not know the handshake answers with an error and keeps
+        # sending plain JSON.
+        if self.encoding != 'json' or self.compression:
+            send_message(sock, {"action": "hello", "data": {"encodings": [self.encoding, 'json'], "compression": self.compression}})
+            recv_response(sock)
+        return sock
+
+    def _request(self, request: dict):
+        sock = self.pool.acquire(self.timeout)
+        try:
+            send_message(sock, request)
+            response = recv_response(sock)
+        except BaseException:
+            self.pool.release(sock, broken=True)
+            raise
+        # The threaded server closes the connection after an error reply.
+        self.pool.release(sock, broken="error" in response)
+        return response
+
+    def ping(self):
+        return self._request({"action": "ping", "data": {}})
+
+    def stats(self):
+        # The server's metrics, in the Prometheus text format.
+        return self._request({"action": "stats", "data": {}})["metrics"]
+
+    def subscribe(self, db_name=None, table_name=None):
+        # Changes of one table, of every table in a database or, with no
+        # arguments, of everything.
+        sock = self.pool.connect()
+        try:
+            send_message(sock, {"action": "subscribe", "data": {"db_name": db_name, "table_name": table_name}})
+            response = recv_response(sock)
+        except BaseException:
+            sock.close()
+            raise
+        if "error" in response:
+            sock.close()
+            raise ProtocolError(response["error"])
+        return ChangeStream(sock)
 
     def create_database(self, db_name):
-        self.client.send(json.dumps({"action": "create_database", "data": {"db_name": db_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+        response = self._request({"action": "create_database", "data": {"db_name": db_name}})
         return response
 
     def drop_database(self, db_name):
-        self.client.send(json.dumps({"action": "drop_database", "data": {"db_name": db_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+        response = self._request({"action": "drop_database", "data": {"db_name": db_name}})
         return response
 
-    def create_table(self, db_name, table_name, columns: str):
-        self.client.send(json.dumps({"action": "create_table", "data": {"db_name": db_name, "table_name": table_name, "columns": columns}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+    def create_table(self, db_name, table_name, columns: str, storage='row'):
+        response = self._request({"action": "create_table", "data": {"db_name": db_name, "table_name": table_name, "columns": columns, "storage": storage}})
         return response
 
     def delete_table(self, db_name, table_name):
-        self.client.send(json.dumps({"action": "delete_table", "data": {"db_name": db_name, "table_name": table_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+        response = self._request({"action": "delete_table", "data": {"db_name": db_name, "table_name": table_name}})
+        return response
+
+    def update_row(self, db_name, table_name, _id, values, durability=None):
+        response = self._request({"action": "update_row", "data": {"db_name": db_name, "table_name": table_name, "values": values, "_id": _id, "durability": durability}})
         return response
 
-    def update_row(self, db_name, table_name, _id, values):
-        self.client.send(json.dumps({"action": "update_row", "data": {"db_name": db_name, "table_name": table_name, "values": values, "_id": _id}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+    def insert_row(self, db_name, table_name, values, durability=None):
+        response = self._request({"action": "insert_row", "data": {"db_name": db_name, "table_name": table_name, "values": values, "durability": durability}})
         return response
 
-    def insert_row(self, db_name, table_name, values):
-        self.client.send(json.dumps({"action": "insert_row", "data": {"db_name": db_name, "table_name": table_name, "values": values}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+    def delete_row(self, db_name, table_name, _id, durability=None):
+        response = self._request({"action": "delete_row", "data": {"db_name": db_name, "table_name": table_name, "_id": _id, "durability": durability}})
         return response
 
-    def delete_row(self, db_name, table_name, _id):
-        self.client.send(json.dumps({"action": "delete_row", "data": {"db_name": db_name, "table_name": table_name, "_id": _id}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+    def insert_rows(self, db_name, table_name, rows, durability=None):
+        response = self._request({"action": "insert_rows", "data": {"db_name": db_name, "table_name": table_name, "rows": rows, "durability": durability}})
         return response
 
-    def delete_repeated(self, db_name, table_name):
-        self.client.send(json.dumps({"action": "delete_repeated", "data": {"db_name": db_name, "table_name": table_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+    def update_rows(self, db_name, table_name, updates: dict, durability=None):
+        response = self._request({"action": "update_rows", "data": {"db_name": db_name, "table_name": table_name, "updates": updates, "durability": durability}})
+        return response
+
+    def delete_rows(self, db_name, table_name, ids, durability=None):
+        response = self._request({"action": "delete_rows", "data": {"db_name": db_name, "table_name": table_name, "ids": ids, "durability": durability}})
+        return response
+
+    def set_dedup(self, db_name, table_name, mode):
+        response = self._request({"action": "set_dedup", "data": {"db_name": db_name, "table_name": table_name, "mode": mode}})
+        return response
+
+    def delete_repeated(self, db_name, table_name, durability=None):
+        response = self._request({"action": "delete_repeated", "data": {"db_name": db_name, "table_name": table_name, "durability": durability}})
         return response["num"]
 
+    def create_index(self, db_name, table_name, column, kind='hash'):
+        response = self._request({"action": "create_index", "data": {"db_name": db_name, "table_name": table_name, "column": column, "kind": kind}})
+        return response
+
+    def drop_index(self, db_name, table_name, column):
+        response = self._request({"action": "drop_index", "data": {"db_name": db_name, "table_name": table_name, "column": column}})
+        return response
+
+    def lookup(self, db_name, table_name, column, value):
+        response = self._request({"action": "lookup", "data": {"db_name": db_name, "table_name": table_name, "column": column, "value": value}})
+        return {row[0]: row[1:] for row in response["rows"]}
+
+    def range_lookup(self, db_name, table_name, column, low=None, high=None, include_low=True, include_high=True):
+        response = self._request({"action": "range_lookup", "data": {
+            "db_name": db_name, "table_name": table_name, "column": column, "low": low, "high": high,
+            "include_low": include_low, "include_high": include_high,
+        }})
+        return {row[0]: row[1:] for row in response["rows"]}
+
+    def query(self, db_name, table_name, columns=None, where=None, order_by=None, limit=None):
+        query = {"columns": columns, "where": where, "order_by": order_by, "limit": limit}
+        response = self._request({"action": "query", "data": {"db_name": db_name, "table_name": table_name, "query": query}})
+        return response["columns"], response["rows"]
+
     def fetch_databases_and_tables(self):
-        self.client.send(json.dumps({"action": "fetch_databases_and_tables", "data": {}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
+        response = self._request({"action": "fetch_databases_and_tables", "data": {}})
         return response['databases']
 
-    def get_table_data(self, db_name, table_name):
-        self.client.send(json.dumps({"action": "get_table_data", "data": {"db_name": db_name, "table_name": table_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
-        return response["types"], response["columns"], response["rows"]
+    def get_table_data(self, db_name, table_name, offset=0, limit=None, cursor=None):
+        return self.get_table_page(db_name, table_name, offset, limit, cursor)[:3]
+
+    def get_table_page(self, db_name, table_name, offset=0, limit=None, cursor=None):
+        response = self._request({"action": "get_table_data", "data": {"db_name": db_name, "table_name": table_name, "offset": offset, "limit": limit, "cursor": cursor}})
+        return response["types"], response["columns"], {row[0]: row[1:] for row in response["rows"]}, response["cursor"]
 
     def _fetch_table_data(self, db_name, table_name):
-        self.client.send(json.dumps({"action": "fetch_table_data", "data": {"db_name": db_name, "table_name": table_name}}).encode('utf-8'))
-        response = json.loads(self.client.recv(4096).decode('utf-8'))
-        return response["types"], response["columns"], response["rows"]
+        response = self._request({"action": "fetch_table_data", "data": {"db_name": db_name, "table_name": table_name}})
+        return response["types"], response["headers"], response["rows"]
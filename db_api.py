@@ -1,9 +1,36 @@
-from fastapi import FastAPI, HTTPException
+import json
+import time
+import asyncio
+from itertools import islice
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from db_classes import ValidationError
 from db_manager import DbManager
+from db_metrics import METRICS
+from db_protocol import COMPRESSION_LEVEL, COMPRESSION_THRESHOLD, STREAM_CHUNK_ROWS
+
+
+# Seconds between keep-alive comments on an idle change stream.
+SSE_KEEPALIVE = 15.0
+
+
+class StreamingGZipMiddleware(GZipMiddleware):
+    # Older Starlette releases gzip event streams too and buffer them until
+    # enough has been written, which holds change events back.
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/changes":
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
 
 
 app = FastAPI()
+# Responses are gzipped for clients that send Accept-Encoding: gzip.
+app.add_middleware(StreamingGZipMiddleware, minimum_size=COMPRESSION_THRESHOLD, compresslevel=COMPRESSION_LEVEL)
 
 db_manager = DbManager()
 
@@ -14,20 +41,122 @@ class DatabaseRequest(BaseModel):
     values: list = None
     columns: list = None
     _id: int = None
+    rows: list = None
+    updates: dict = None
+    ids: list = None
+    storage: str = 'row'
+    column: str = None
+    kind: str = 'hash'
+    query: dict = None
+    mode: str = None
+    durability: str = None
+
+
+# Routes are plain functions, so FastAPI runs them on its thread pool and
+# the manager's disk writes and lock waits never block the event loop.
+
+
+def route_label(request: Request):
+    # Paths that matched no route share one label, like unknown socket
+    # actions, so clients can not add new series.
+    route = request.scope.get("route")
+    return route.path if route is not None else 'unknown'
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    # Added after the gzip middleware, so it wraps it and counts the bytes
+    # that actually go out. Streamed replies are timed up to their headers.
+    # HTTP has no long-lived sessions, so requests in flight stand in for
+    # connections.
+    METRICS.connection_opened('http')
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        METRICS.observe_request('http', route_label(request), time.perf_counter() - start, error=True)
+        raise
+    finally:
+        METRICS.connection_closed('http')
+    METRICS.add_bytes(
+        'http', received=int(request.headers.get("content-length", 0)),
+        sent=int(response.headers.get("content-length", 0)),
+    )
+    METRICS.observe_request(
+        'http', route_label(request), time.perf_counter() - start, error=response.status_code >= 500,
+        db_name=request.query_params.get("db_name"), table_name=request.query_params.get("table_name"),
+    )
+    return response
 
 
 @app.on_event("startup")
 async def startup_event():
-    db_manager.load()
+    await run_in_threadpool(db_manager.load, 'lazy')
+
+
+def table_etag(db_name, table_name):
+    try:
+        return f'W/"{db_manager.table_version(db_name, table_name)}"'
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Table not found")
+
+
+def not_modified(request: Request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+
+def bad_request(error):
+    # A rejected batch lists every bad row as [row, column, message].
+    if isinstance(error, ValidationError):
+        return HTTPException(status_code=400, detail={"message": str(error), "errors": error.errors})
+    return HTTPException(status_code=400, detail=str(error))
+
+
+def ndjson_lines(header, rows):
+    # One JSON document per line: the header first, then one [id, *values]
+    # list per row. Lines are sent in chunks to keep the per-write overhead low.
+    yield json.dumps(header) + '\n'
+    rows = iter(rows)
+    while chunk := list(islice(rows, STREAM_CHUNK_ROWS)):
+        yield ''.join(json.dumps(row) + '\n' for row in chunk)
+
+
+async def sse_events(db_name, table_name):
+    # Server-sent events, one per change, with the table version as the
+    # event id. Keep-alive comments let a dropped client be noticed. Runs on
+    # the event loop and is woken by writers, so an idle subscriber does not
+    # hold a thread of the pool the routes run on.
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscription = db_manager.feed.subscribe(db_name, table_name, notify=lambda: loop.call_soon_threadsafe(wakeup.set))
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            wakeup.clear()
+            while (event := subscription.get_nowait()) is not None:
+                if event.get("resync"):
+                    yield f'event: resync\ndata: {json.dumps(event)}\n\n'
+                else:
+                    yield f'id: {event["version"]}\ndata: {json.dumps(event)}\n\n'
+    finally:
+        subscription.close()
 
 
 @app.get("/databases")
-async def fetch_databases_and_tables():
+def fetch_databases_and_tables():
     return {"databases": db_manager.fetch_databases_and_tables()}
 
 
 @app.post("/create_database")
-async def create_database(request: DatabaseRequest):
+def create_database(request: DatabaseRequest):
     if not request.db_name:
         raise HTTPException(status_code=400, detail="Database name is required")
     db_manager.create_database(request.db_name)
@@ -35,38 +164,80 @@ async def create_database(request: DatabaseRequest):
 
 
 @app.post("/create_table")
-async def create_table(request: DatabaseRequest):
+def create_table(request: DatabaseRequest):
     if not all([request.db_name, request.table_name, request.columns]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    db_manager.create_table(request.db_name, request.table_name, request.columns)
+    db_manager.create_table(request.db_name, request.table_name, request.columns, request.storage)
     return {"status": "Table created"}
 
 
 @app.post("/insert_row")
-async def insert_row(request: DatabaseRequest):
+def insert_row(request: DatabaseRequest):
     if not all([request.db_name, request.table_name, request.values]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    db_manager.insert_row(request.db_name, request.table_name, request.values)
-    return {"status": "Record inserted"}
+    try:
+        _id = db_manager.insert_row(request.db_name, request.table_name, request.values, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
+    return {"status": "Record inserted", "_id": _id}
+
+@app.post("/insert_rows")
+def insert_rows(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name, request.rows]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        ids = db_manager.insert_rows(request.db_name, request.table_name, request.rows, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
+    return {"status": "Records inserted", "ids": ids}
+
 
 @app.put("/update_row")
-async def update_row(request: DatabaseRequest):
+def update_row(request: DatabaseRequest):
     if not all([request.db_name, request.table_name, request._id, request.values]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    db_manager.update_row(request.db_name, request.table_name, request._id, request.values)
+    try:
+        db_manager.update_row(request.db_name, request.table_name, request._id, request.values, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
     return {"status": "Record updated"}
 
 
 @app.delete("/delete_row")
-async def delete_row(request: DatabaseRequest):
+def delete_row(request: DatabaseRequest):
     if not all([request.db_name, request.table_name, request._id]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    db_manager.delete_row(request.db_name, request.table_name, request._id)
+    try:
+        db_manager.delete_row(request.db_name, request.table_name, request._id, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
     return {"status": "Record deleted"}
 
 
+@app.put("/update_rows")
+def update_rows(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name, request.updates]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        db_manager.update_rows(request.db_name, request.table_name, request.updates, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
+    return {"status": "Records updated"}
+
+
+@app.delete("/delete_rows")
+def delete_rows(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name, request.ids]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        db_manager.delete_rows(request.db_name, request.table_name, request.ids, request.durability)
+    except (ValueError, TypeError, IndexError) as e:
+        raise bad_request(e)
+    return {"status": "Records deleted"}
+
+
 @app.delete("/delete_table")
-async def delete_table(request: DatabaseRequest):
+def delete_table(request: DatabaseRequest):
     if not all([request.db_name, request.table_name]):
         raise HTTPException(status_code=400, detail="Missing required fields")
     db_manager.delete_table(request.db_name, request.table_name)
@@ -74,7 +245,7 @@ async def delete_table(request: DatabaseRequest):
 
 
 @app.delete("/drop_database")
-async def drop_database(request: DatabaseRequest):
+def drop_database(request: DatabaseRequest):
     if not request.db_name:
         raise HTTPException(status_code=400, detail="Database name is required")
     db_manager.drop_database(request.db_name)
@@ -82,16 +253,110 @@ async def drop_database(request: DatabaseRequest):
 
 
 @app.get("/table_data")
-async def get_table_data(db_name: str, table_name: str):
+def get_table_data(request: Request, db_name: str, table_name: str, offset: int = 0, limit: int = None,
+                   cursor: str = None, stream: bool = False):
     if not all([db_name, table_name]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    _, columns, rows = db_manager.get_table_data(db_name, table_name)
+    etag = table_etag(db_name, table_name)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        if stream:
+            _, columns, rows, next_cursor = db_manager.iter_table_page(db_name, table_name, offset, limit, cursor)
+            return StreamingResponse(
+                ndjson_lines({"columns": columns, "cursor": next_cursor}, rows),
+                media_type="application/x-ndjson", headers={"ETag": etag},
+            )
+        _, columns, rows, next_cursor = db_manager.get_table_page(db_name, table_name, offset, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse({"columns": columns, "rows": rows, "cursor": next_cursor}, headers={"ETag": etag})
+
+
+@app.post("/create_index")
+def create_index(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name, request.column]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        db_manager.create_index(request.db_name, request.table_name, request.column, request.kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "Index created"}
+
+
+@app.delete("/drop_index")
+def drop_index(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name, request.column]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        db_manager.drop_index(request.db_name, request.table_name, request.column)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "Index dropped"}
+
+
+@app.get("/lookup")
+def lookup(request: Request, db_name: str, table_name: str, column: str, value: str):
+    etag = table_etag(db_name, table_name)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        rows = db_manager.lookup_rows(db_name, table_name, column, value)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse({"rows": rows}, headers={"ETag": etag})
+
+
+@app.get("/range_lookup")
+def range_lookup(request: Request, db_name: str, table_name: str, column: str, low: str = None, high: str = None,
+                 include_low: bool = True, include_high: bool = True):
+    etag = table_etag(db_name, table_name)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    try:
+        rows = db_manager.range_rows(db_name, table_name, column, low, high, include_low, include_high)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse({"rows": rows}, headers={"ETag": etag})
+
+
+@app.post("/query")
+def query(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        columns, rows = db_manager.query(request.db_name, request.table_name, request.query or {})
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"columns": columns, "rows": rows}
 
 
+@app.post("/set_dedup")
+def set_dedup(request: DatabaseRequest):
+    if not all([request.db_name, request.table_name]):
+        raise HTTPException(status_code=400, detail="Missing required fields")
+    try:
+        db_manager.set_dedup(request.db_name, request.table_name, request.mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"status": "Dedup mode set"}
+
+
 @app.post("/delete_repeated")
-async def delete_repeated(request: DatabaseRequest):
+def delete_repeated(request: DatabaseRequest):
     if not all([request.db_name, request.table_name]):
         raise HTTPException(status_code=400, detail="Missing required fields")
-    num = db_manager.delete_repeated(request.db_name, request.table_name)
+    num = db_manager.delete_repeated(request.db_name, request.table_name, request.durability)
     return {"num": num}
+
+
+@app.get("/changes")
+async def changes(db_name: str = None, table_name: str = None):
+    return StreamingResponse(
+        sse_events(db_name, table_name), media_type="text/event-stream", headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
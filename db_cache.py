@@ -0,0 +1,47 @@
+import threading
+from collections import OrderedDict
+
+
+RESPONSE_CACHE_BYTES = 64 * 2 ** 20
+
+
+class ResponseCache:
+    # LRU of encoded replies, capped by the total size of the entries. Keys
+    # carry the table version, so entries of a table that changed are never
+    # hit again and simply age out.
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[tuple, tuple[object, int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -1,7 +1,16 @@
-from datetime import datetime
+import json
+import base64
+import threading
+from itertools import islice
+from array import array
+from datetime import date, datetime
 from enum import Enum
+from functools import lru_cache
 from uuid import uuid4
 
+from db_index import HashIndex, SortedIndex, ContentIndex, INDEX_KINDS
+from db_lock import RWLock
+
 
 class Type(Enum):
     ID = 'ID'
@@ -21,9 +30,136 @@ class Field:
         self.ftype = ftype
 
 
+DATE_FORMAT = '%Y.%m.%d'
+
+
+# INT columns are stored as signed 64-bit integers by the columnar engine
+# and binary snapshots, so every table accepts only that range.
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _parse_int(value):
+    value = int(value)
+    assert INT_MIN <= value <= INT_MAX, 'INT type supports only 64-bit integers'
+    return value
+
+
+def _parse_char(value):
+    assert len(value) == 1, 'CHAR type supports only symbols'
+    return value
+
+
+@lru_cache(maxsize=65536)
+def _parse_date(value):
+    # Fast path for the canonical zero-padded YYYY.MM.DD form, strptime
+    # handles everything else it accepts. Dates repeat a lot in real tables,
+    # so parsed values are cached as well.
+    if len(value) == 10 and value[4] == '.' and value[7] == '.':
+        year, month, day = value[:4], value[5:7], value[8:]
+        if (year + month + day).isdigit():
+            return date(int(year), int(month), int(day)).toordinal()
+    return datetime.strptime(value, DATE_FORMAT).toordinal()
+
+
+def _parse_interval(value):
+    dates = value.split('-')
+    assert len(dates) == 2
+    start, end = _parse_date(dates[0]), _parse_date(dates[1])
+    assert start < end
+    return start, end
+
+
+def _render_date(value):
+    # strftime does not zero-pad years before 1000, which strptime then
+    # rejects when the value is read back.
+    day = date.fromordinal(value)
+    return f'{day.year:04d}.{day.month:02d}.{day.day:02d}'
+
+
+def _render_interval(value):
+    return f'{_render_date(value[0])}-{_render_date(value[1])}'
+
+
+PARSERS = {
+    Type.INT: _parse_int,
+    Type.REAL: float,
+    Type.CHAR: _parse_char,
+    Type.STRING: str,
+    Type.ID: str,
+    Type.DATE: _parse_date,
+    Type.DATEINVL: _parse_interval,
+}
+
+RENDERERS = {
+    Type.DATE: _render_date,
+    Type.DATEINVL: _render_interval,
+}
+
+
+class ValidationError(TypeError):
+    def __init__(self, errors: list[tuple[int, str, str]]):
+        self.errors = errors
+        row_index, column, message = errors[0]
+        more = f" (and {len(errors) - 1} more)" if len(errors) > 1 else ""
+        super().__init__(f"Row {row_index}, column {column}: {message}{more}")
+
+
 class Schema:
     def __init__(self, fields: list[Field]):
         self.fields: list[Field] = fields
+        self.parsers = [PARSERS[field.ftype] for field in fields]
+        self.positions = {field.name: index for index, field in enumerate(fields)}
+
+    def position(self, column):
+        if column not in self.positions:
+            raise ValueError(f"Column {column} not found.")
+        return self.positions[column]
+
+    def coerce_value(self, column, value):
+        parser = self.parsers[self.position(column)]
+        try:
+            return parser(value)
+        except Exception as e:
+            raise TypeError(e)
+
+    def coerce(self, row_data):
+        # Parses every cell into its native value: int, float, str, a date
+        # ordinal or a pair of ordinals for intervals.
+        if len(row_data) != len(self.fields):
+            raise ValueError("Row data does not match table schema.")
+        try:
+            return [parser(value) for parser, value in zip(self.parsers, row_data)]
+        except Exception as e:
+            raise TypeError(e)
+
+    def coerce_rows(self, rows_data):
+        # Parses a batch column by column. Every bad cell is collected, so a
+        # single ValidationError describes the whole batch.
+        if not rows_data:
+            return []
+        bad_rows = [index for index, row_data in enumerate(rows_data) if len(row_data) != len(self.fields)]
+        if bad_rows:
+            raise ValueError(f"Rows {bad_rows} do not match table schema.")
+        columns = []
+        errors = []
+        for field, parser, column in zip(self.fields, self.parsers, zip(*rows_data)):
+            try:
+                columns.append(list(map(parser, column)))
+            except Exception:
+                for row_index, value in enumerate(column):
+                    try:
+                        parser(value)
+                    except Exception as e:
+                        errors.append((row_index, field.name, str(e) or type(e).__name__))
+        if errors:
+            raise ValidationError(errors)
+        return [list(values) for values in zip(*columns)]
+
+    def render(self, values):
+        return [
+            RENDERERS[field.ftype](value) if field.ftype in RENDERERS else value
+            for field, value in zip(self.fields, values)
+        ]
 
 
 class Row:
@@ -38,70 +174,462 @@ class Row:
         return str(self.values)
 
 
+class RowStore(dict):
+    def __init__(self, schema: Schema):
+        super().__init__()
+        self.schema = schema
+
+    def put(self, _id, values):
+        if _id in self:
+            self[_id].update(values)
+        else:
+            self[_id] = Row(self.schema, values)
+
+    def records(self):
+        return ((key, row.values) for key, row in self.items())
+
+    def records_range(self, start, stop):
+        return [(key, row.values) for key, row in islice(self.items(), start, stop)]
+
+    def column(self, index):
+        return [row.values[index] for row in self.values()]
+
+
+def _pack_interval(value):
+    return (value[0] << 32) | value[1]
+
+
+def _unpack_interval(value):
+    return value >> 32, value & 0xFFFFFFFF
+
+
+COLUMN_CODECS = {
+    Type.INT: ('q', None, None),
+    Type.REAL: ('d', None, None),
+    Type.DATE: ('q', None, None),
+    Type.DATEINVL: ('q', _pack_interval, _unpack_interval),
+}
+
+
+class ColumnStore:
+    # Keeps one typed array per column and a map from row id to slot. Deleted
+    # slots are left as holes and reclaimed once they make up half the store.
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        self.codecs = [COLUMN_CODECS.get(field.ftype) for field in schema.fields]
+        self.columns = [array(codec[0]) if codec else [] for codec in self.codecs]
+        self.slots: dict[str, int] = {}
+        self.holes = 0
+        self.mapped = False
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __contains__(self, _id):
+        return _id in self.slots
+
+    def __getitem__(self, _id):
+        return Row(self.schema, self._values(self.slots[_id]))
+
+    def __delitem__(self, _id):
+        self.detach()
+        self.slots.pop(_id)
+        self.holes += 1
+        if self.holes > 1024 and self.holes > len(self.slots):
+            self._reclaim()
+
+    def keys(self):
+        return self.slots.keys()
+
+    def get(self, _id, default=None):
+        return self[_id] if _id in self.slots else default
+
+    def pop(self, _id, default=None):
+        if _id not in self.slots:
+            return default
+        row = self[_id]
+        del self[_id]
+        return row
+
+    def items(self):
+        return ((key, Row(self.schema, values)) for key, values in self.records())
+
+    def put(self, _id, values):
+        self.detach()
+        encoded = [codec[1](value) if codec and codec[1] else value for codec, value in zip(self.codecs, values)]
+        # A value a typed array refuses must not leave the columns of
+        # different lengths, so whatever was written is undone.
+        if (slot := self.slots.get(_id)) is not None:
+            previous = [column[slot] for column in self.columns]
+            try:
+                for column, value in zip(self.columns, encoded):
+                    column[slot] = value
+            except BaseException:
+                for column, value in zip(self.columns, previous):
+                    column[slot] = value
+                raise
+        else:
+            slot = len(self.columns[0]) if self.columns else 0
+            try:
+                for column, value in zip(self.columns, encoded):
+                    column.append(value)
+            except BaseException:
+                for column in self.columns:
+                    del column[slot:]
+                raise
+            self.slots[_id] = slot
+
+    def attach(self, ids, columns):
+        # Serves the store straight from read-only column buffers, such as
+        # views into a memory-mapped snapshot. They are copied into regular
+        # arrays on the first write.
+        self.columns = list(columns)
+        self.slots = {_id: slot for slot, _id in enumerate(ids)}
+        self.holes = 0
+        self.mapped = True
+
+    def detach(self):
+        if not self.mapped:
+            return
+        columns = []
+        for codec, column in zip(self.codecs, self.columns):
+            if codec is None:
+                columns.append(list(column))
+            elif isinstance(column, array):
+                columns.append(column)
+            else:
+                columns.append(array(codec[0]))
+                columns[-1].frombytes(column.cast('B'))
+        self.columns = columns
+        self.mapped = False
+
+    def records(self):
+        if not self.holes:
+            return zip(self.slots, map(list, zip(*map(self.column, range(len(self.columns))))))
+        return ((key, self._values(slot)) for key, slot in self.slots.items())
+
+    def records_range(self, start, stop):
+        return [(key, self._values(slot)) for key, slot in islice(self.slots.items(), start, stop)]
+
+    def column(self, index):
+        # Without holes or packed values the stored array is returned as is,
+        # so scans over a numeric column run without touching Python rows.
+        codec = self.codecs[index]
+        column = self._live_column(index)
+        if codec and codec[2]:
+            return list(map(codec[2], column))
+        return column
+
+    def _live_column(self, index):
+        column = self.columns[index]
+        if not self.holes:
+            return column
+        if isinstance(column, array):
+            return array(column.typecode, map(column.__getitem__, self.slots.values()))
+        return [column[slot] for slot in self.slots.values()]
+
+    def _values(self, slot):
+        return [codec[2](column[slot]) if codec and codec[2] else column[slot] for codec, column in zip(self.codecs, self.columns)]
+
+    def _reclaim(self):
+        self.columns = [self._live_column(index) for index in range(len(self.columns))]
+        self.slots = {key: slot for slot, key in enumerate(self.slots)}
+        self.holes = 0
+
+
+DEDUP_MODES = (None, 'track', 'reject')
+
+STORAGES = {
+    'row': RowStore,
+    'columnar': ColumnStore,
+}
+
+
 class Table:
-    def __init__(self, name: str, schema: Schema):
+    # Reads take `lock` themselves. Mutations expect the caller to hold it
+    # for writing, so a change and its log record go in under one lock.
+    # Every change bumps `version`, which is what snapshots are keyed on.
+
+    def __init__(self, name: str, schema: Schema, storage='row'):
+        if storage not in STORAGES:
+            raise ValueError(f"Storage {storage} is not supported.")
         self.name = name
         self.schema = schema
-        self.rows: dict[str, Row] = {}
+        self.storage = storage
+        self._rows: RowStore | ColumnStore = STORAGES[storage](schema)
+        self._loader = None
+        self._loading = False
+        self._load_lock = threading.RLock()
+        self.indexes: dict[str, HashIndex | SortedIndex] = {}
+        self.dedup = None
+        self.content_index: ContentIndex | None = None
+        self.lock = RWLock()
+        # version only grows while this object lives, uid tells apart a
+        # table that was dropped and created again or reloaded.
+        self.uid = uuid4().hex
+        self.version = 0
+        # Set under the write lock when the table is deleted, for writers
+        # that looked it up before and were waiting on the lock.
+        self.dropped = False
+        self._snapshot = None
+
+    @property
+    def rows(self) -> RowStore | ColumnStore:
+        self._finish_load()
+        return self._rows
+
+    @property
+    def is_loaded(self):
+        return self._loader is None
+
+    def set_loader(self, loader):
+        # The loader fills the table the first time its rows are needed.
+        # Other threads wait on the lock until loading has finished.
+        self._loader = loader
+
+    def _finish_load(self):
+        # The loader also restores indexes and the dedup mode, so methods
+        # that read those without going through rows call this first.
+        if self._loader is not None:
+            self._load()
+
+    def _load(self):
+        with self._load_lock:
+            if self._loader is None or self._loading:
+                return
+            self._loading = True
+            try:
+                self._loader(self)
+                self._loader = None
+            finally:
+                self._loading = False
+
+    def snapshot(self):
+        # All records as a list of (id, values) pairs, shared by every read
+        # until the table changes. Values lists are replaced on update and
+        # never modified in place, so the list stays consistent after the
+        # lock is released and long reads do not hold up writers. Columnar
+        # tables build the list for each read and do not keep it, as it
+        # takes many times the memory of their arrays.
+        with self.lock.read():
+            cached = self._snapshot
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            records = list(self.rows.records())
+            if self.storage == 'row':
+                self._snapshot = (self.version, records)
+            return records
+
+    def restore_rows(self, ids, rows_values):
+        for _id, values in zip(ids, rows_values):
+            self._put(_id, values)
+
+    def set_dedup(self, mode):
+        # 'track' keeps a content index so duplicates are known as rows are
+        # written, 'reject' additionally refuses rows that already exist.
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Dedup mode {mode} is not supported.")
+        self._finish_load()
+        if mode is None:
+            self.content_index = None
+        elif self.content_index is None:
+            content_index = ContentIndex()
+            content_index.build(self.rows.records())
+            if mode == 'reject' and content_index.repeated:
+                raise ValueError("Table already contains duplicate rows.")
+            self.content_index = content_index
+        elif mode == 'reject' and self.content_index.repeated:
+            raise ValueError("Table already contains duplicate rows.")
+        self.dedup = mode
+
+    def duplicates(self):
+        self._finish_load()
+        if self.content_index is not None:
+            return self.content_index.duplicates()
+        seen = set()
+        duplicates = []
+        for key, values in self.rows.records():
+            row_values = tuple(values)
+            if row_values in seen:
+                duplicates.append(key)
+            else:
+                seen.add(row_values)
+        return duplicates
+
+    def create_index(self, column, kind='hash'):
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Index kind {kind} is not supported.")
+        position = self.schema.position(column)
+        index = INDEX_KINDS[kind]()
+        index.build(zip(self.rows.keys(), self.rows.column(position)))
+        self.indexes[column] = index
+
+    def drop_index(self, column):
+        self._finish_load()
+        if column not in self.indexes:
+            raise ValueError(f"Index on {column} does not exist.")
+        del self.indexes[column]
+
+    def lookup(self, column, value):
+        value = self.schema.coerce_value(column, value)
+        with self.lock.read():
+            self._finish_load()
+            return self._index(column).lookup(value)
+
+    def range_lookup(self, column, low=None, high=None, include_low=True, include_high=True):
+        if low is not None:
+            low = self.schema.coerce_value(column, low)
+        if high is not None:
+            high = self.schema.coerce_value(column, high)
+        with self.lock.read():
+            self._finish_load()
+            return self._index(column).range(low, high, include_low, include_high)
+
+    def fetch(self, ids):
+        with self.lock.read():
+            rows = self.rows
+            return [(_id, rows[_id].values) for _id in ids]
+
+    def _index(self, column):
+        if column not in self.indexes:
+            raise ValueError(f"Column {column} has no index.")
+        return self.indexes[column]
+
+    def _check_unique(self, rows):
+        self._finish_load()
+        if self.dedup != 'reject':
+            return
+        seen = set()
+        for _id, values in rows:
+            key = tuple(values)
+            if key in seen or any(holder != _id for holder in self.content_index.holders(values)):
+                raise ValueError("Duplicate row.")
+            seen.add(key)
+
+    def _put(self, _id, values):
+        if (self.indexes or self.content_index is not None) and _id in self.rows:
+            self._unindex(_id, self.rows[_id].values)
+        self.rows.put(_id, values)
+        self.version += 1
+        for column, index in self.indexes.items():
+            index.add(_id, values[self.schema.positions[column]])
+        if self.content_index is not None:
+            self.content_index.add(_id, values)
+
+    def _remove(self, _id):
+        if self.indexes or self.content_index is not None:
+            self._unindex(_id, self.rows[_id].values)
+        del self.rows[_id]
+        self.version += 1
+
+    def _unindex(self, _id, values):
+        for column, index in self.indexes.items():
+            index.remove(_id, values[self.schema.positions[column]])
+        if self.content_index is not None:
+            self.content_index.remove(_id, values)
 
     def insert_row(self, row_data, _id=None):
-        if len(row_data) != len(self.schema.fields):
-            raise ValueError("Row data does not match table schema.")
-        self.validate(row_data)
-        row = Row(self.schema, row_data)
+        values = self.schema.coerce(row_data)
         if _id is None:
             _id = str(uuid4())
-        self.rows[_id] = row
+        self._check_unique([(_id, values)])
+        self._put(_id, values)
         return _id
 
+    def insert_rows(self, rows_data, ids=None):
+        rows_values = self.schema.coerce_rows(rows_data)
+        if ids is None:
+            ids = [str(uuid4()) for _ in rows_values]
+        self._check_unique(zip(ids, rows_values))
+        for _id, values in zip(ids, rows_values):
+            self._put(_id, values)
+        return ids
+
     def update_row(self, row_index, new_data):
         if row_index not in self.rows.keys():
             raise IndexError("Row index out of range.")
-        self.validate(new_data)
-        self.rows[row_index].update(new_data)
+        values = self.schema.coerce(new_data)
+        self._check_unique([(row_index, values)])
+        self._put(row_index, values)
+
+    def update_rows(self, updates: dict):
+        for row_index in updates:
+            if row_index not in self.rows.keys():
+                raise IndexError("Row index out of range.")
+        rows = list(zip(updates, self.schema.coerce_rows(list(updates.values()))))
+        self._check_unique(rows)
+        for row_index, values in rows:
+            self._put(row_index, values)
 
     def delete_row(self, row_index):
         if row_index not in self.rows.keys():
             raise IndexError("Row index out of range.")
-        del self.rows[row_index]
+        self._remove(row_index)
+
+    def delete_rows(self, row_indexes):
+        for row_index in row_indexes:
+            if row_index not in self.rows.keys():
+                raise IndexError("Row index out of range.")
+        for row_index in set(row_indexes):
+            self._remove(row_index)
+
+    def page(self, offset=0, limit=None, cursor=None):
+        records, next_cursor = self.page_records(offset, limit, cursor)
+        return {key: self.schema.render(values) for key, values in records}, next_cursor
+
+    def page_records(self, offset=0, limit=None, cursor=None):
+        # Rows are returned in insertion order. The cursor remembers the last
+        # returned id together with its position, so a page can be resumed
+        # even when rows before it were inserted or deleted in the meantime.
+        # A bounded page is read straight from the store, so it costs the
+        # size of the page and not a copy of the table after every write.
+        # Only unbounded reads go through the shared snapshot.
+        with self.lock.read():
+            rows = self.rows
+            if cursor is not None:
+                offset = self._resolve_cursor(cursor, rows)
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError("Offset and limit must be non-negative.")
+            total = len(rows)
+            stop = None if limit is None else offset + limit
+            page = self.snapshot()[offset:] if stop is None else rows.records_range(offset, stop)
+        next_cursor = None
+        if page and stop is not None and stop < total:
+            last_key = page[-1][0]
+            next_cursor = base64.urlsafe_b64encode(json.dumps([stop, last_key]).encode('utf-8')).decode('ascii')
+        return page, next_cursor
+
+    def _resolve_cursor(self, cursor, rows):
+        try:
+            position, last_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except Exception:
+            raise ValueError("Invalid cursor.")
+        keys = rows.keys()
+        if 0 < position <= len(rows) and next(islice(keys, position - 1, None)) == last_key:
+            return position
+        for index, key in enumerate(keys):
+            if key == last_key:
+                return index + 1
+        return position
 
     def display(self):
         for row in self.rows:
             print(row)
 
-    def validate(self, row_data):
-        try:
-            for col_data, col in zip(self.schema.fields, row_data):
-                match col_data.ftype:
-                    case Type.INT:
-                        int(col)
-                    case Type.REAL:
-                        float(col)
-                    case Type.CHAR:
-                        assert len(col) == 1, 'CHAR type supports only symbols'
-                    case Type.STRING:
-                        pass
-                    case Type.DATE:
-                        datetime.strptime(col, '%Y.%m.%d')
-                    case Type.DATEINVL:
-                        dates = col.split('-')
-                        assert len(dates) == 2
-                        d1 = datetime.strptime(dates[0], '%Y.%m.%d')
-                        d2 = datetime.strptime(dates[1], '%Y.%m.%d')
-                        assert d1.timestamp() < d2.timestamp()
-        except Exception as e:
-            raise TypeError(e)
-
 
 class Database:
     def __init__(self, name) -> None:
         self.name: str = name
         self.tables: dict[str, Table] = {}
 
-    def create_table(self, name, schema):
+    def create_table(self, name, schema, storage='row'):
         if name in self.tables:
             raise ValueError(f"Table {name} already exists.")
-        self.tables[name] = Table(name, schema)
+        self.tables[name] = Table(name, schema, storage)
 
     def drop_table(self, name):
         if name in self.tables:
@@ -0,0 +1,100 @@
+import queue
+import threading
+
+
+FEED_QUEUE_SIZE = 10000
+
+
+class Subscription:
+    # Deltas of the tables a subscriber asked for, in the order they were
+    # committed to each table. A subscriber that falls FEED_QUEUE_SIZE events
+    # behind loses what is queued and gets a single {"resync": True} event
+    # instead, after which it should fetch the tables again.
+
+    def __init__(self, feed: 'ChangeFeed', db_name=None, table_name=None, maxsize=FEED_QUEUE_SIZE, notify=None) -> None:
+        self.feed = feed
+        self.db_name = db_name
+        self.table_name = table_name
+        # Called from the writer's thread after each event is queued, for
+        # consumers that can not block on get.
+        self.notify = notify
+        self.queue = queue.Queue(maxsize)
+        self.lagged = False
+        self.lock = threading.Lock()
+
+    def matches(self, db_name, table_name):
+        return self.db_name in (None, db_name) and self.table_name in (None, table_name)
+
+    def offer(self, event):
+        with self.lock:
+            if not self.lagged:
+                try:
+                    self.queue.put_nowait(event)
+                except queue.Full:
+                    self.lagged = True
+        if self.notify is not None:
+            # A consumer whose event loop has already closed is dropped
+            # rather than failing the writer that published.
+            try:
+                self.notify()
+            except RuntimeError:
+                self.close()
+
+    def get(self, timeout=None):
+        # Returns the next event, or None if none came within timeout.
+        with self.lock:
+            if self.lagged:
+                self.lagged = False
+                self.queue = queue.Queue(self.queue.maxsize)
+                return {"resync": True}
+            events = self.queue
+        try:
+            return events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+
+class ChangeFeed:
+    # Fans out row deltas to subscribers. Writers publish while they still
+    # hold the table's write lock, so the events of one table reach every
+    # subscriber in commit order, each with the table version it produced.
+
+    def __init__(self) -> None:
+        self.subscriptions: set[Subscription] = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, db_name=None, table_name=None, maxsize=FEED_QUEUE_SIZE, notify=None):
+        subscription = Subscription(self, db_name, table_name, maxsize, notify)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, db_name, table_name, version, records):
+        if not self.subscriptions:
+            return
+        with self.lock:
+            subscriptions = [s for s in self.subscriptions if s.matches(db_name, table_name)]
+        if not subscriptions:
+            return
+        event = {
+            "db_name": db_name,
+            "table_name": table_name,
+            "version": version,
+            "changes": [[op, _id, list(values)] for op, _id, values in records],
+        }
+        for subscription in subscriptions:
+            subscription.offer(event)
@@ -0,0 +1,114 @@
+from bisect import bisect_left, bisect_right
+
+
+class HashIndex:
+    kind = 'hash'
+
+    def __init__(self):
+        self.entries: dict[object, set[str]] = {}
+
+    def build(self, items):
+        self.entries.clear()
+        for _id, value in items:
+            self.add(_id, value)
+
+    def add(self, _id, value):
+        self.entries.setdefault(value, set()).add(_id)
+
+    def remove(self, _id, value):
+        ids = self.entries.get(value)
+        if ids is not None:
+            ids.discard(_id)
+            if not ids:
+                del self.entries[value]
+
+    def lookup(self, value):
+        return list(self.entries.get(value, ()))
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        raise ValueError("Range lookups need a sorted index.")
+
+
+class SortedIndex:
+    kind = 'sorted'
+
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+
+    def build(self, items):
+        pairs = sorted((value, _id) for _id, value in items)
+        self.keys = [value for value, _ in pairs]
+        self.ids = [_id for _, _id in pairs]
+
+    def add(self, _id, value):
+        position = bisect_right(self.keys, value)
+        self.keys.insert(position, value)
+        self.ids.insert(position, _id)
+
+    def remove(self, _id, value):
+        position = bisect_left(self.keys, value)
+        while position < len(self.keys) and self.keys[position] == value:
+            if self.ids[position] == _id:
+                del self.keys[position]
+                del self.ids[position]
+                return
+            position += 1
+
+    def lookup(self, value):
+        return self.ids[bisect_left(self.keys, value):bisect_right(self.keys, value)]
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        start = 0
+        stop = len(self.keys)
+        if low is not None:
+            start = bisect_left(self.keys, low) if include_low else bisect_right(self.keys, low)
+        if high is not None:
+            stop = bisect_right(self.keys, high) if include_high else bisect_left(self.keys, high)
+        return self.ids[start:stop]
+
+
+class ContentIndex:
+    # Maps the full content of a row to the ids holding it. Keys with more
+    # than one id are tracked separately, so duplicates are found without
+    # scanning the table.
+
+    def __init__(self):
+        self.entries: dict[tuple, list[str]] = {}
+        self.repeated: set[tuple] = set()
+
+    def build(self, records):
+        self.entries.clear()
+        self.repeated.clear()
+        for _id, values in records:
+            self.add(_id, values)
+
+    def add(self, _id, values):
+        key = tuple(values)
+        ids = self.entries.setdefault(key, [])
+        ids.append(_id)
+        if len(ids) > 1:
+            self.repeated.add(key)
+
+    def remove(self, _id, values):
+        key = tuple(values)
+        ids = self.entries.get(key)
+        if ids is None or _id not in ids:
+            return
+        ids.remove(_id)
+        if len(ids) < 2:
+            self.repeated.discard(key)
+        if not ids:
+            del self.entries[key]
+
+    def holders(self, values):
+        return self.entries.get(tuple(values), [])
+
+    def duplicates(self):
+        return [_id for key in self.repeated for _id in self.entries[key][1:]]
+
+
+INDEX_KINDS = {
+    'hash': HashIndex,
+    'sorted': SortedIndex,
+}
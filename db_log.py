@@ -0,0 +1,206 @@
+import os
+import csv
+import time
+import shutil
+import threading
+
+
+LOG_INSERT = 'I'
+LOG_UPDATE = 'U'
+LOG_DELETE = 'D'
+
+# async acknowledges as soon as a record is appended, batched once the next
+# group commit has flushed and fsynced it, and sync fsyncs before returning.
+DURABILITY_LEVELS = ('async', 'batched', 'sync')
+FLUSH_INTERVAL = 0.01
+
+
+class TableLog:
+    """Append-only log of row mutations made since the last CSV snapshot."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        # Records are numbered as they are appended, so a writer can wait
+        # until everything up to its own record has reached the disk.
+        self.appended = 0
+        self.synced = 0
+        self.error = None
+        self._file = None
+        self._writer = None
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+
+    @property
+    def rotated_path(self):
+        return f'{self.path}.old'
+
+    def append_many(self, records):
+        with self._cond:
+            if self._file is None:
+                self._file = open(self.path, mode='a', newline='', encoding='utf-8')
+                self._writer = csv.writer(self._file)
+            self._writer.writerows([op, _id] + list(values) for op, _id, values in records)
+            self.records += len(records)
+            self.appended += len(records)
+            return self.appended
+
+    def sync(self, upto=None):
+        # Flushes and fsyncs everything appended so far. The fsync runs
+        # without holding the append lock, and callers whose records were
+        # covered by someone else's fsync return straight away.
+        with self._sync_lock:
+            with self._cond:
+                target = self.appended
+                if self.synced >= (target if upto is None else upto):
+                    return
+                if self._file is None:
+                    self._mark_synced(target)
+                    return
+                self._file.flush()
+                fd = self._file.fileno()
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                raise
+            with self._cond:
+                self._mark_synced(target)
+
+    def wait_synced(self, upto):
+        with self._cond:
+            while self.synced < upto:
+                if self.error is not None:
+                    raise self.error
+                self._cond.wait()
+
+    def _mark_synced(self, target):
+        self.synced = max(self.synced, target)
+        self.error = None
+        self._cond.notify_all()
+
+    def rotate(self):
+        # Moves the live log aside so a snapshot can be written while new
+        # records keep going to a fresh file. A rotated log left over from an
+        # interrupted compaction is kept and extended instead of overwritten.
+        self.close()
+        if os.path.exists(self.path):
+            if os.path.exists(self.rotated_path):
+                with open(self.rotated_path, mode='ab') as dst, open(self.path, mode='rb') as src:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+        self.records = 0
+
+    def discard_rotated(self):
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.rotated_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.records = 0
+
+    def close(self):
+        with self._sync_lock, self._cond:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                self._writer = None
+            self._mark_synced(self.appended)
+
+
+class LogFlusher:
+    # Group commit. Appends only mark their log dirty, and one pass per
+    # interval flushes and fsyncs each dirty log once for every writer
+    # that is waiting on it.
+
+    def __init__(self, interval=FLUSH_INTERVAL) -> None:
+        self.interval = interval
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def mark(self, log: TableLog):
+        with self.lock:
+            self.dirty.add(log)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.wakeup.set()
+            thread.join()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                logs, self.dirty = self.dirty, set()
+                stopping = self.thread is not threading.current_thread()
+            for log in logs:
+                try:
+                    log.sync()
+                except Exception as e:
+                    print(f"Flushing {log.path} failed: {e}")
+            if stopping:
+                return
+
+
+def replay_log(path, table):
+    # Replaying must be idempotent: after a compaction that was interrupted
+    # before the rotated log was discarded, its records are replayed on top
+    # of a snapshot that already contains them. An update of a row deleted
+    # later is applied as an insert, which the delete that follows undoes.
+    applied = 0
+    if not os.path.exists(path):
+        return applied
+    _drop_torn_tail(path)
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        for record in csv.reader(file):
+            if len(record) < 2:
+                continue
+            op, _id, values = record[0], record[1], record[2:]
+            if op == LOG_INSERT or (op == LOG_UPDATE and _id not in table.rows):
+                table.insert_row(values, _id)
+            elif op == LOG_UPDATE:
+                table.update_row(_id, values)
+            elif op == LOG_DELETE and _id in table.rows:
+                table.delete_row(_id)
+            applied += 1
+    return applied
+
+
+def _drop_torn_tail(path):
+    # A crash in the middle of an append leaves a last record without its
+    # line end. It was never completely written, so it is cut off rather
+    # than replayed, and later appends start on a fresh line.
+    with open(path, mode='rb+') as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - 65536)
+            file.seek(start)
+            chunk = file.read(position - start)
+            if position == end and chunk.endswith(b'\n'):
+                return
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                file.truncate(start + newline + 1)
+                return
+            position = start
+        file.truncate(0)
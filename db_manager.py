@@ -1,11 +1,29 @@
 import os
 import csv
+import json
+import queue
+import threading
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from contextlib import contextmanager, nullcontext
 
-from db_classes import Schema, Database, Type, Field
+from db_classes import Schema, Database, Type, Field, ColumnStore
+from db_snapshot import Snapshot, read_snapshot_header, write_snapshot
+from db_query import Query
+from db_feed import ChangeFeed
+from db_metrics import METRICS
+from db_log import TableLog, LogFlusher, replay_log, LOG_INSERT, LOG_UPDATE, LOG_DELETE, DURABILITY_LEVELS, FLUSH_INTERVAL
 
 
 DB_FOLDER_PATH = 'db'
+COMPACT_THRESHOLD = 1000
+LOAD_MODES = ('eager', 'parallel', 'lazy')
+CATALOG_FILE = 'catalog.json'
+SNAPSHOT_FORMATS = {
+    'csv': '.csv',
+    'binary': '.snap',
+}
 
 
 class AutoCreateDict(defaultdict):
@@ -14,40 +32,146 @@ class AutoCreateDict(defaultdict):
         return self[key]
 
 
+def parse_table_file(file_path):
+    # Module level so it can run in a worker process. Returns parsed values,
+    # which are cheap to send back compared to parsing them again.
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        csv_reader = csv.reader(file)
+        types = next(csv_reader)
+        headers = next(csv_reader)
+        rows = list(csv_reader)
+    schema = Schema([Field(val[0], Type(val[1])) for val in zip(headers[1:], types[1:])])
+    return types, headers, [row[0] for row in rows], schema.coerce_rows([row[1:] for row in rows])
+
+
+def fetch_table_header(file_path):
+    if file_path.endswith('.snap'):
+        return read_snapshot_header(file_path)
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        csv_reader = csv.reader(file)
+        return next(csv_reader), next(csv_reader)
+
+
+def write_csv(file_path, types, headers, schema, records):
+    with open(f'{file_path}.tmp', mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(types)
+        writer.writerow(headers)
+        writer.writerows([key] + schema.render(values) for key, values in records)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{file_path}.tmp', file_path)
+
+
+class Compactor:
+    def __init__(self, dbm: 'DbManager') -> None:
+        self.dbm = dbm
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, db_name, table_name):
+        with self.lock:
+            if (db_name, table_name) in self.pending:
+                return
+            self.pending.add((db_name, table_name))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.queue.put((db_name, table_name))
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while (item := self.queue.get()) is not None:
+            with self.lock:
+                self.pending.discard(item)
+            try:
+                self.dbm.compact(*item)
+            except Exception as e:
+                print(f"Compaction of {item[0]}-{item[1]} failed: {e}")
+
+
 class DbManager:
-    def __init__(self, db_folder_path=DB_FOLDER_PATH) -> None:
+    def __init__(self, db_folder_path=DB_FOLDER_PATH, compact_threshold=COMPACT_THRESHOLD, snapshot_format='csv',
+                 durability='batched', flush_interval=FLUSH_INTERVAL) -> None:
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Snapshot format {snapshot_format} is not supported.")
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Durability {durability} is not supported.")
+        self.durability = durability
         self.db_folder_path = db_folder_path
+        self.snapshot_format = snapshot_format
         self.databases: dict[str, Database] = AutoCreateDict()
+        self.catalog: dict[str, dict[str, dict]] = {}
+        self.compact_threshold = compact_threshold
+        self._logs: dict[tuple[str, str], TableLog] = {}
+        # _lock guards the catalog and the set of tables, each table's own
+        # lock guards its rows and log. Locks are taken in the order
+        # _compact_lock, _lock, table lock.
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._logs_lock = threading.Lock()
+        self._compactor = Compactor(self)
+        self._flusher = LogFlusher(flush_interval)
+        self.feed = ChangeFeed()
+        self.metrics = METRICS
 
-    def load(self):
-        csv_files = [f for f in os.listdir(self.db_folder_path) if f.endswith('.csv')]
+    def load(self, mode='eager', workers=None):
+        # eager parses every table now, parallel does the same across a
+        # process pool, and lazy only reads the headers and parses each
+        # table's rows on first access. Binary snapshots are memory-mapped
+        # in every mode, so they are never sent to the pool.
+        if mode not in LOAD_MODES:
+            raise ValueError(f"Load mode {mode} is not supported.")
+        self.catalog = self._load_catalog()
+        tables = {}
+        for db_name, db_tables in self.catalog.items():
+            self.databases[db_name]
+            for table_name in db_tables:
+                if file_path := self._snapshot_path(db_name, table_name):
+                    tables[(db_name, table_name)] = file_path
 
-        for file_name in csv_files:
-            pure_name = file_name.split('.')[0]
-            split_name = pure_name.split('-')
-            types, headers, rows = self._fetch_table_data(split_name[0], split_name[1])
-            self.databases[split_name[0]].create_table(
-                split_name[1],
-                Schema([Field(val[0], Type(val[1])) for val in zip(headers[1:], types[1:])]),
-            )
-            for row in rows:
-                self.databases[split_name[0]].tables[split_name[1]].insert_row(row[1:], row[0])
+        parsed = {}
+        csv_paths = [path for path in tables.values() if path.endswith('.csv')]
+        if mode == 'parallel' and len(csv_paths) > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                parsed = dict(zip(csv_paths, pool.map(parse_table_file, csv_paths)))
+
+        for (db_name, table_name), file_path in tables.items():
+            types, headers = parsed[file_path][:2] if file_path in parsed else fetch_table_header(file_path)
+            table = self._register_table(db_name, table_name, types, headers)
+            if mode == 'lazy':
+                table.set_loader(partial(self._load_table_rows, db_name, table_name, file_path))
+            else:
+                self._load_table_rows(db_name, table_name, file_path, table, parsed.get(file_path))
 
     def create_database(self, db_name):
-        self.databases[db_name] = Database(db_name)
+        with self._lock:
+            if db_name in self.catalog:
+                raise ValueError(f"Database {db_name} already exists.")
+            self.databases[db_name] = Database(db_name)
+            self.catalog[db_name] = {}
+            self._save_catalog()
 
     def drop_database(self, db_name):
-        del self.databases[db_name]
-        file_paths = [
-            f"{self.db_folder_path}/{f}"
-            for f in os.listdir(self.db_folder_path)
-            if f.endswith(".csv") and f.split("-")[0] == db_name
-        ]
-        for file_path in file_paths:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        with self._compact_lock, self._lock:
+            tables = self.databases.pop(db_name).tables
+            for table_name in self.catalog.pop(db_name, {}):
+                table = tables.get(table_name)
+                with table.lock.write() if table is not None else nullcontext():
+                    if table is not None:
+                        table.dropped = True
+                    self._remove_table_files(db_name, table_name)
+            self._save_catalog()
 
-    def create_table(self, db_name, table_name, columns: str):
+    def create_table(self, db_name, table_name, columns: str, storage='row'):
         fields = []
         for column in columns.split(','):
             col_data = column.split(':')
@@ -56,83 +180,358 @@ class DbManager:
             if col_data[1] not in Type._member_names_:
                 raise ValueError("Wrong Columns definition")
             fields.append(Field(name=col_data[0], ftype=Type(col_data[1])))
-        self.databases[db_name].create_table(table_name, Schema(fields))
-        self._save_table_data(db_name, table_name)
+        with self._lock:
+            self.databases[db_name].create_table(table_name, Schema(fields), storage)
+            self._save_table_meta(db_name, table_name)
+            self._save_table_data(db_name, table_name)
 
     def delete_table(self, db_name, table_name):
-        del self.databases[db_name].tables[table_name]
-        file_path = f'{self.db_folder_path}/{db_name}-{table_name}.csv'
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        with self._compact_lock, self._lock:
+            table = self._table(db_name, table_name)
+            with table.lock.write():
+                table.dropped = True
+                del self.databases[db_name].tables[table_name]
+            self.catalog.get(db_name, {}).pop(table_name, None)
+            self._remove_table_files(db_name, table_name)
+            self._save_catalog()
 
-    def update_row(self, db_name, table_name, _id, values):
-        self.databases[db_name].tables[table_name].update_row(_id, values)
-        self._save_table_data(db_name, table_name)
+    def update_row(self, db_name, table_name, _id, values, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            table.update_row(_id, values)
+            commit = self._append_log(db_name, table_name, [(LOG_UPDATE, _id, self._rendered(table, _id))])
+        self._commit(commit, durability)
 
-    def insert_row(self, db_name, table_name, values):
-        _id = self.databases[db_name].tables[table_name].insert_row(values)
-        self._save_table_data(db_name, table_name)
+    def insert_row(self, db_name, table_name, values, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            _id = table.insert_row(values)
+            commit = self._append_log(db_name, table_name, [(LOG_INSERT, _id, self._rendered(table, _id))])
+        self._commit(commit, durability)
         return _id
 
-    def delete_row(self, db_name, table_name, _id):
-        self.databases[db_name].tables[table_name].delete_row(_id)
-        self._save_table_data(db_name, table_name)
+    def delete_row(self, db_name, table_name, _id, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            table.delete_row(_id)
+            commit = self._append_log(db_name, table_name, [(LOG_DELETE, _id, ())])
+        self._commit(commit, durability)
 
-    def delete_repeated(self, db_name, table_name):
-        unique_rows = defaultdict(list)
-        duplicates_to_delete = []
+    def insert_rows(self, db_name, table_name, rows, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            ids = table.insert_rows(rows)
+            commit = self._append_log(db_name, table_name, [(LOG_INSERT, _id, self._rendered(table, _id)) for _id in ids])
+        self._commit(commit, durability)
+        return ids
 
-        for key, row in self.databases[db_name].tables[table_name].rows.items():
-            row_values = tuple(row.values)
-            if row_values not in unique_rows:
-                unique_rows[row_values].append(key)
-            else:
-                duplicates_to_delete.append(key)
+    def update_rows(self, db_name, table_name, updates: dict, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            table.update_rows(updates)
+            commit = self._append_log(db_name, table_name, [(LOG_UPDATE, _id, self._rendered(table, _id)) for _id in updates])
+        self._commit(commit, durability)
 
-        for duplicate_key in duplicates_to_delete:
-            self.delete_row(db_name, table_name, duplicate_key)
+    def delete_rows(self, db_name, table_name, ids, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            table.delete_rows(ids)
+            commit = self._append_log(db_name, table_name, [(LOG_DELETE, _id, ()) for _id in ids])
+        self._commit(commit, durability)
 
-        return len(duplicates_to_delete)
+    def create_index(self, db_name, table_name, column, kind='hash'):
+        with self._lock, self._writing(db_name, table_name) as table:
+            table.create_index(column, kind)
+            self._save_table_meta(db_name, table_name)
 
-    def fetch_databases_and_tables(self):
-        databases = defaultdict(list)
+    def drop_index(self, db_name, table_name, column):
+        with self._lock, self._writing(db_name, table_name) as table:
+            table.drop_index(column)
+            self._save_table_meta(db_name, table_name)
+
+    def lookup_rows(self, db_name, table_name, column, value):
+        table = self._table(db_name, table_name)
+        with table.lock.read():
+            records = table.fetch(table.lookup(column, value))
+        return self._rendered_rows(table, records)
+
+    def range_rows(self, db_name, table_name, column, low=None, high=None, include_low=True, include_high=True):
+        table = self._table(db_name, table_name)
+        with table.lock.read():
+            records = table.fetch(table.range_lookup(column, low, high, include_low, include_high))
+        return self._rendered_rows(table, records)
 
-        csv_files = [f for f in os.listdir(self.db_folder_path) if f.endswith('.csv')]
+    def query(self, db_name, table_name, query: dict):
+        return Query(self._table(db_name, table_name), query).execute()
 
-        for file_name in csv_files:
-            pure_name = file_name.split('.')[0]
-            split_name = pure_name.split('-')
-            databases[split_name[0]].append(split_name[1])
+    def set_dedup(self, db_name, table_name, mode):
+        with self._lock, self._writing(db_name, table_name) as table:
+            table.set_dedup(mode)
+            self._save_table_meta(db_name, table_name)
 
-        return databases
+    def delete_repeated(self, db_name, table_name, durability=None):
+        durability = self._durability(durability)
+        with self._writing(db_name, table_name) as table:
+            duplicates_to_delete = table.duplicates()
+            if not duplicates_to_delete:
+                return 0
+            table.delete_rows(duplicates_to_delete)
+            commit = self._append_log(db_name, table_name, [(LOG_DELETE, _id, ()) for _id in duplicates_to_delete])
+        self._commit(commit, durability)
+        return len(duplicates_to_delete)
+
+    def fetch_databases_and_tables(self):
+        with self._lock:
+            return {db_name: list(tables) for db_name, tables in self.catalog.items()}
+
+    def get_table_data(self, db_name, table_name, offset=0, limit=None, cursor=None):
+        if page := self.get_table_page(db_name, table_name, offset, limit, cursor):
+            return page[:3]
 
-    def get_table_data(self, db_name, table_name):
+    def get_table_page(self, db_name, table_name, offset=0, limit=None, cursor=None):
         if db_name in self.databases:
             if table := self.databases[db_name].tables.get(table_name, None):
-                new_rows = {key: val.values for key, val in table.rows.items()}
-                return (
-                    [Type.ID.value] + [field.ftype.value for field in table.schema.fields],
-                    ['id'] + [field.name for field in table.schema.fields],
-                    new_rows,
-                )
+                rows, next_cursor = table.page(offset, limit, cursor)
+                return (*self._table_header(table), rows, next_cursor)
+
+    def iter_table_page(self, db_name, table_name, offset=0, limit=None, cursor=None):
+        # Like get_table_page, but rows are rendered one at a time as the
+        # caller iterates, as [id, *values] lists.
+        table = self._table(db_name, table_name)
+        records, next_cursor = table.page_records(offset, limit, cursor)
+        render = table.schema.render
+        return (*self._table_header(table), ([key] + render(values) for key, values in records), next_cursor)
+
+    def table_version(self, db_name, table_name):
+        # Read before the data it describes, so a concurrent write can only
+        # make it older than what the caller returns, never newer.
+        table = self._table(db_name, table_name)
+        with table.lock.read():
+            if not table.is_loaded:
+                table.rows
+            return f'{table.uid}-{table.version}'
+
+    def export_csv(self, db_name, table_name, file_path):
+        table = self._table(db_name, table_name)
+        write_csv(file_path, *self._table_header(table), table.schema, table.snapshot())
+
+    def import_csv(self, db_name, table_name, file_path, storage='row'):
+        types, headers, ids, rows = parse_table_file(file_path)
+        with self._lock:
+            schema = Schema([Field(val[0], Type(val[1])) for val in zip(headers[1:], types[1:])])
+            self.databases[db_name].create_table(table_name, schema, storage)
+            self.databases[db_name].tables[table_name].restore_rows(ids, rows)
+            self._save_table_meta(db_name, table_name)
+            self._save_table_data(db_name, table_name)
 
     def _fetch_table_data(self, db_name, table_name):
-        with open(f'{self.db_folder_path}/{db_name}-{table_name}.csv', mode='r', encoding='utf-8') as file:
-            csv_reader = csv.reader(file)
-            types = next(csv_reader)
-            headers = next(csv_reader)
-            rows = [row for row in csv_reader]
-            return types, headers, rows
-
-    def _save_table_data(self, db_name, table_name):
-        with open(f'{self.db_folder_path}/{db_name}-{table_name}.csv', mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            types = [Type.ID]
-            headers = ['id']
-            for field in self.databases[db_name].tables[table_name].schema.fields:
-                types.append(field.ftype.value)
-                headers.append(field.name)
-            writer.writerow(types)
-            writer.writerow(headers)
-            for key, value in self.databases[db_name].tables[table_name].rows.items():
-                writer.writerow([key] + value.values)
+        # The files lag behind the log until the next compaction, so rows
+        # come from the table itself.
+        table = self._table(db_name, table_name)
+        render = table.schema.render
+        return (*self._table_header(table), [[key] + render(values) for key, values in table.snapshot()])
+
+    def compact(self, db_name, table_name):
+        with self._compact_lock:
+            with self._lock:
+                if db_name not in self.databases or table_name not in self.databases[db_name].tables:
+                    return
+                table = self.databases[db_name].tables[table_name]
+            # Writers are held off only while the log is rotated and the
+            # snapshot taken, not while it is written out.
+            with table.lock.read():
+                log = self._get_log(db_name, table_name)
+                log.rotate()
+                records = table.snapshot()
+            self._save_table_data(db_name, table_name, records)
+            log.discard_rotated()
+
+    def close(self):
+        self._compactor.stop()
+        self._flusher.stop()
+        with self._logs_lock:
+            for log in self._logs.values():
+                log.close()
+
+    def _table(self, db_name, table_name):
+        # databases adds a database for any name it is asked for, which only
+        # create_table and load are meant to do.
+        database = self.databases.get(db_name)
+        if database is None or table_name not in database.tables:
+            raise KeyError(table_name)
+        return database.tables[table_name]
+
+    @contextmanager
+    def _writing(self, db_name, table_name):
+        # Holds the table's write lock. A writer that waited on it while the
+        # table was deleted, and maybe created again under the same name,
+        # must change neither the old table nor the new one's log.
+        table = self._table(db_name, table_name)
+        with table.lock.write():
+            if table.dropped:
+                raise ValueError(f"Table {table_name} does not exist.")
+            yield table
+
+    def _get_log(self, db_name, table_name):
+        with self._logs_lock:
+            if (db_name, table_name) not in self._logs:
+                # A writer that was waiting on a table while it was dropped
+                # must not bring its log file back.
+                database = self.databases.get(db_name)
+                if database is None or table_name not in database.tables:
+                    raise ValueError(f"Table {table_name} does not exist.")
+                self._logs[(db_name, table_name)] = TableLog(f'{self.db_folder_path}/{db_name}-{table_name}.log')
+            return self._logs[(db_name, table_name)]
+
+    def _rendered(self, table, _id):
+        return table.schema.render(table.rows[_id].values)
+
+    def _rendered_rows(self, table, records):
+        return {_id: table.schema.render(values) for _id, values in records}
+
+    def _append_log(self, db_name, table_name, records):
+        log = self._get_log(db_name, table_name)
+        position = log.append_many(records)
+        self._flusher.mark(log)
+        if log.records >= self.compact_threshold:
+            self._compactor.schedule(db_name, table_name)
+        # Still under the table's write lock, so subscribers see the changes
+        # of a table in the order they were made.
+        table = self.databases[db_name].tables[table_name]
+        self.feed.publish(db_name, table_name, f'{table.uid}-{table.version}', records)
+        return log, position
+
+    def _durability(self, durability):
+        if durability is None:
+            return self.durability
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Durability {durability} is not supported.")
+        return durability
+
+    def _commit(self, commit, durability):
+        # Runs after the table lock is released, so writers waiting for the
+        # same group commit do not hold each other up.
+        log, position = commit
+        if durability == 'sync':
+            log.sync(position)
+        elif durability == 'batched':
+            log.wait_synced(position)
+
+    def _register_table(self, db_name, table_name, types, headers):
+        meta = self._fetch_table_meta(db_name, table_name)
+        self.databases[db_name].create_table(
+            table_name,
+            Schema([Field(val[0], Type(val[1])) for val in zip(headers[1:], types[1:])]),
+            meta.get('storage', 'row'),
+        )
+        return self.databases[db_name].tables[table_name]
+
+    def _load_table_rows(self, db_name, table_name, file_path, table, parsed=None):
+        if file_path.endswith('.snap'):
+            snapshot = Snapshot(file_path)
+            if isinstance(table.rows, ColumnStore):
+                table.rows.attach(snapshot.ids, snapshot.columns)
+            else:
+                table.restore_rows(snapshot.ids, map(list, zip(*snapshot.decoded_columns())))
+        else:
+            _, _, ids, rows = parsed or parse_table_file(file_path)
+            table.restore_rows(ids, rows)
+        self._finish_table_load(db_name, table_name, table)
+
+    def _finish_table_load(self, db_name, table_name, table):
+        meta = self._fetch_table_meta(db_name, table_name)
+        log = self._get_log(db_name, table_name)
+        replay_log(log.rotated_path, table)
+        log.records = replay_log(log.path, table)
+        for column, kind in meta.get('indexes', {}).items():
+            table.create_index(column, kind)
+        table.set_dedup(meta.get('dedup'))
+        if os.path.exists(log.rotated_path) or log.records >= self.compact_threshold:
+            self._compactor.schedule(db_name, table_name)
+
+    def _snapshot_path(self, db_name, table_name):
+        # If a switch of snapshot format was interrupted and both files
+        # exist, the newer one wins.
+        file_paths = [
+            f'{self.db_folder_path}/{db_name}-{table_name}{extension}'
+            for extension in SNAPSHOT_FORMATS.values()
+        ]
+        file_paths = [file_path for file_path in file_paths if os.path.exists(file_path)]
+        return max(file_paths, key=os.path.getmtime, default=None)
+
+    def _remove_table_files(self, db_name, table_name):
+        with self._logs_lock:
+            log = self._logs.pop((db_name, table_name), None)
+        if log:
+            log.close()
+        file_path = f'{self.db_folder_path}/{db_name}-{table_name}'
+        for extension in (*SNAPSHOT_FORMATS.values(), '.json', '.log', '.log.old'):
+            if os.path.exists(file_path + extension):
+                os.remove(file_path + extension)
+
+    def _load_catalog(self):
+        file_path = f'{self.db_folder_path}/{CATALOG_FILE}'
+        if os.path.exists(file_path):
+            with open(file_path, mode='r', encoding='utf-8') as file:
+                return json.load(file)
+
+        # Folders written before the catalog existed only have snapshot files
+        # and per-table .json metadata, so the catalog is rebuilt from them once.
+        catalog = {}
+        for file_name in sorted(os.listdir(self.db_folder_path)):
+            if file_name.endswith(tuple(SNAPSHOT_FORMATS.values())):
+                db_name, table_name = file_name.rsplit('.', 1)[0].split('-')
+                meta_path = f'{self.db_folder_path}/{db_name}-{table_name}.json'
+                meta = {}
+                if os.path.exists(meta_path):
+                    with open(meta_path, mode='r', encoding='utf-8') as file:
+                        meta = json.load(file)
+                catalog.setdefault(db_name, {})[table_name] = meta
+        self.catalog = catalog
+        self._save_catalog()
+        for db_name, tables in catalog.items():
+            for table_name in tables:
+                if os.path.exists(f'{self.db_folder_path}/{db_name}-{table_name}.json'):
+                    os.remove(f'{self.db_folder_path}/{db_name}-{table_name}.json')
+        return catalog
+
+    def _save_catalog(self):
+        file_path = f'{self.db_folder_path}/{CATALOG_FILE}'
+        with open(f'{file_path}.tmp', mode='w', encoding='utf-8') as file:
+            json.dump(self.catalog, file)
+        os.replace(f'{file_path}.tmp', file_path)
+
+    def _table_header(self, table):
+        return (
+            [Type.ID.value] + [field.ftype.value for field in table.schema.fields],
+            ['id'] + [field.name for field in table.schema.fields],
+        )
+
+    def _fetch_table_meta(self, db_name, table_name):
+        return self.catalog.get(db_name, {}).get(table_name, {})
+
+    def _save_table_meta(self, db_name, table_name):
+        table = self.databases[db_name].tables[table_name]
+        self.catalog.setdefault(db_name, {})[table_name] = {
+            'storage': table.storage,
+            'indexes': {column: index.kind for column, index in table.indexes.items()},
+            'dedup': table.dedup,
+        }
+        self._save_catalog()
+
+    def _save_table_data(self, db_name, table_name, records=None):
+        with self.metrics.phase('save_table_data'):
+            table = self.databases[db_name].tables[table_name]
+            if records is None:
+                records = list(table.rows.records())
+            types, headers = self._table_header(table)
+            file_path = f'{self.db_folder_path}/{db_name}-{table_name}'
+            if self.snapshot_format == 'binary':
+                if os.name == 'nt' and isinstance(table.rows, ColumnStore):
+                    table.rows.detach()
+                write_snapshot(f'{file_path}.snap', types, headers, records)
+            else:
+                write_csv(f'{file_path}.csv', types, headers, table.schema, records)
+            for extension in SNAPSHOT_FORMATS.values():
+                if extension != SNAPSHOT_FORMATS[self.snapshot_format] and os.path.exists(file_path + extension):
+                    os.remove(file_path + extension)
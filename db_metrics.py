@@ -0,0 +1,139 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds, as in Prometheus' default buckets with a few
+# finer ones at the low end, where most socket requests land.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_OPERATION_SECONDS = 1.0
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        # One count per bucket plus one for everything above the last.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Counters, gauges and histograms of one process, rendered in the
+    # Prometheus text format. `server` labels tell the socket servers and
+    # the HTTP API apart. Requests slower than slow_threshold seconds are
+    # also passed to slow_log, with their table and row count.
+
+    def __init__(self, slow_threshold=SLOW_OPERATION_SECONDS, slow_log=print) -> None:
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+        self.lock = threading.Lock()
+        self.latency: dict[tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.errors: dict[tuple[str, str], int] = defaultdict(int)
+        self.rows: dict[tuple[str, str], int] = defaultdict(int)
+        self.slow: dict[tuple[str, str], int] = defaultdict(int)
+        self.bytes_received: dict[str, int] = defaultdict(int)
+        self.bytes_sent: dict[str, int] = defaultdict(int)
+        self.connections: dict[str, int] = defaultdict(int)
+        self.phases: dict[str, Histogram] = defaultdict(Histogram)
+
+    def observe_request(self, server, action, seconds, rows=0, error=False, db_name=None, table_name=None):
+        key = (server, action)
+        slow = self.slow_threshold is not None and seconds >= self.slow_threshold
+        with self.lock:
+            self.latency[key].observe(seconds)
+            self.rows[key] += rows
+            if error:
+                self.errors[key] += 1
+            if slow:
+                self.slow[key] += 1
+        if slow:
+            table = f'{db_name}-{table_name}' if table_name else db_name or '-'
+            self.slow_log(f"Slow {server} {action} on {table}: {seconds * 1000:.1f} ms, {rows} rows")
+
+    def add_bytes(self, server, received=0, sent=0):
+        with self.lock:
+            self.bytes_received[server] += received
+            self.bytes_sent[server] += sent
+
+    def connection_opened(self, server):
+        with self.lock:
+            self.connections[server] += 1
+
+    def connection_closed(self, server):
+        with self.lock:
+            self.connections[server] -= 1
+
+    def observe_phase(self, phase, seconds):
+        with self.lock:
+            self.phases[phase].observe(seconds)
+
+    @contextmanager
+    def phase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            _histogram(lines, 'db_request_duration_seconds', "Time to serve a request.",
+                       {_labels(server=server, action=action): h for (server, action), h in self.latency.items()})
+            _metric(lines, 'db_requests_total', 'counter', "Requests served.",
+                    {_labels(server=server, action=action): h.count for (server, action), h in self.latency.items()})
+            _metric(lines, 'db_request_errors_total', 'counter', "Requests answered with an error.",
+                    {_labels(server=server, action=action): n for (server, action), n in self.errors.items()})
+            _metric(lines, 'db_rows_total', 'counter', "Rows returned or changed by requests.",
+                    {_labels(server=server, action=action): n for (server, action), n in self.rows.items()})
+            _metric(lines, 'db_slow_requests_total', 'counter', "Requests above the slow operation threshold.",
+                    {_labels(server=server, action=action): n for (server, action), n in self.slow.items()})
+            _metric(lines, 'db_received_bytes_total', 'counter', "Request bytes read.",
+                    {_labels(server=server): n for server, n in self.bytes_received.items()})
+            _metric(lines, 'db_sent_bytes_total', 'counter', "Reply bytes written.",
+                    {_labels(server=server): n for server, n in self.bytes_sent.items()})
+            _metric(lines, 'db_active_connections', 'gauge', "Open client connections.",
+                    {_labels(server=server): n for server, n in self.connections.items()})
+            _histogram(lines, 'db_phase_duration_seconds', "Time spent saving snapshots and (de)serializing messages.",
+                       {_labels(phase=phase): h for phase, h in self.phases.items()})
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{_escape(str(value))}"' for name, value in labels.items())
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _metric(lines, name, kind, description, samples):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} {kind}')
+    for labels, value in samples.items():
+        lines.append(f'{name}{{{labels}}} {value}')
+
+
+def _histogram(lines, name, description, histograms):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} histogram')
+    for labels, histogram in histograms.items():
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+# Shared by everything in the process, like the manager of db_api.py.
+METRICS = Metrics()
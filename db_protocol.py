@@ -0,0 +1,183 @@
+import json
+import zlib
+import socket
+import asyncio
+import struct
+from itertools import islice
+
+from db_wire import BATCH_MARKER, encode_batch, decode_batch, retag_batch
+
+
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 2 ** 31 - 1
+# The top bit of the length header marks a zlib-compressed payload.
+COMPRESSED = 2 ** 31
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 1024
+STREAM_CHUNK_ROWS = 1000
+# Encodings a client can ask for in its hello. Control messages are always
+# JSON, the encoding only applies to the row chunks of streamed replies.
+ENCODINGS = ('json', 'binary')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_message(message: dict | bytes, compression: dict | None = None):
+    # Binary batches come in already encoded. Payloads below the negotiated
+    # threshold are sent as they are, compressing them costs more than it saves.
+    payload = message if isinstance(message, bytes) else json.dumps(message).encode('utf-8')
+    flag = 0
+    if compression and len(payload) >= compression["threshold"]:
+        payload = zlib.compress(payload, compression["level"])
+        flag = COMPRESSED
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ProtocolError("Message is too large.")
+    return HEADER.pack(flag | len(payload)) + payload
+
+
+def send_message(sock: socket.socket, message: dict, compression: dict | None = None):
+    sock.sendall(encode_message(message, compression))
+
+
+def recv_message(sock: socket.socket):
+    frame = recv_frame(sock)
+    return None if frame is None else decode_payload(*frame)
+
+
+def recv_frame(sock: socket.socket):
+    # The payload, still encoded, and whether it is compressed.
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (size,) = HEADER.unpack(header)
+    payload = _recv_exactly(sock, size & ~COMPRESSED)
+    if payload is None:
+        raise ProtocolError("Connection closed in the middle of a message.")
+    return payload, bool(size & COMPRESSED)
+
+
+def decode_payload(payload: bytes, compressed=False):
+    if compressed:
+        payload = zlib.decompress(payload)
+    if payload[:1] == BATCH_MARKER:
+        return decode_batch(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+def negotiate_encoding(data: dict):
+    for encoding in (data or {}).get("encodings", ()):
+        if encoding in ENCODINGS:
+            return encoding
+    return 'json'
+
+
+def negotiate_compression(data: dict):
+    requested = (data or {}).get("compression")
+    if not requested:
+        return None
+    level = requested.get("level", COMPRESSION_LEVEL)
+    threshold = requested.get("threshold", COMPRESSION_THRESHOLD)
+    if not isinstance(level, int) or not 0 <= level <= 9 or not isinstance(threshold, int) or threshold < 0:
+        raise ValueError("Invalid compression settings.")
+    return {"level": level, "threshold": threshold}
+
+
+def stream_frames(header: dict, rows, chunk_size=STREAM_CHUNK_ROWS, encoding='json', sink: list | None = None):
+    # A streamed result is a header frame, any number of chunk frames and an
+    # end frame, so the sender never holds more than one chunk encoded at once.
+    # Every frame repeats the request id, if there is one. Chunks are encoded
+    # without the id and tagged afterwards, and when a sink is given the
+    # untagged chunks are collected in it so the reply can be replayed.
+    tag = {"id": header["id"]} if "id" in header else {}
+    yield {**header, "stream": True}
+    rows = iter(rows)
+    count = 0
+    while chunk := list(islice(rows, chunk_size)):
+        payload = encode_chunk(chunk, header.get("types"), encoding)
+        if sink is not None:
+            sink.append((len(chunk), payload))
+        yield tag_chunk(payload, header.get("id"), encoding)
+        count += len(chunk)
+    yield {**tag, "end": True, "count": count}
+
+
+def replay_frames(header: dict, chunks, encoding='json'):
+    # Same frames as stream_frames, from chunks it collected earlier.
+    tag = {"id": header["id"]} if "id" in header else {}
+    yield {**header, "stream": True}
+    for _, payload in chunks:
+        yield tag_chunk(payload, header.get("id"), encoding)
+    yield {**tag, "end": True, "count": sum(count for count, _ in chunks)}
+
+
+def encode_chunk(chunk, types=None, encoding='json'):
+    if encoding == 'binary':
+        return encode_batch(chunk, types)
+    return json.dumps(chunk).encode('utf-8')
+
+
+def tag_chunk(payload: bytes, request_id=None, encoding='json'):
+    if encoding == 'binary':
+        return payload if request_id is None else retag_batch(payload, request_id)
+    if request_id is None:
+        return b'{"chunk": ' + payload + b'}'
+    return b'{"id": ' + json.dumps(request_id).encode('utf-8') + b', "chunk": ' + payload + b'}'
+
+
+def send_stream(sock: socket.socket, header: dict, rows, chunk_size=STREAM_CHUNK_ROWS, encoding='json', compression=None):
+    for frame in stream_frames(header, rows, chunk_size, encoding):
+        send_message(sock, frame, compression)
+
+
+def recv_response(sock: socket.socket):
+    response = recv_message(sock)
+    if response is None:
+        raise ProtocolError("Connection closed by server.")
+    if not response.pop("stream", False):
+        return response
+    rows = []
+    while True:
+        frame = recv_message(sock)
+        if frame is None:
+            raise ProtocolError("Connection closed in the middle of a stream.")
+        if "error" in frame:
+            return frame
+        if frame.get("end"):
+            break
+        rows.extend(frame["chunk"])
+    response["rows"] = rows
+    return response
+
+
+async def read_message(reader: asyncio.StreamReader):
+    frame = await read_frame(reader)
+    return None if frame is None else decode_payload(*frame)
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError("Connection closed in the middle of a frame.")
+        return None
+    (size,) = HEADER.unpack(header)
+    try:
+        payload = await reader.readexactly(size & ~COMPRESSED)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed in the middle of a message.")
+    return payload, bool(size & COMPRESSED)
+
+
+def _recv_exactly(sock: socket.socket, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        part = sock.recv(min(size - len(buffer), 65536))
+        if not part:
+            if buffer:
+                raise ProtocolError("Connection closed in the middle of a frame.")
+            return None
+        buffer.extend(part)
+    return bytes(buffer)
@@ -0,0 +1,168 @@
+import heapq
+import operator
+from itertools import islice
+
+from db_classes import Table, Schema, Type, PARSERS
+
+
+COMPARISONS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+RANGE_BOUNDS = {
+    '<': lambda value: (None, value, True, False),
+    '<=': lambda value: (None, value, True, True),
+    '>': lambda value: (value, None, False, True),
+    '>=': lambda value: (value, None, True, True),
+    'between': lambda value: (value[0], value[1], True, True),
+}
+
+
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class Query:
+    """Projection, WHERE, ORDER BY and LIMIT over one table.
+
+    A query is a plain dict, so it can travel as JSON:
+
+        {"columns": ["name"],
+         "where": {"and": [{"column": "age", "op": ">=", "value": 30},
+                           {"column": "born", "op": "between", "value": ["1990.01.01", "1999.12.31"]}]},
+         "order_by": [["age", "desc"], "name"],
+         "limit": 10}
+
+    Supported operators are =, !=, <, <=, >, >=, in and between. DATEINVL
+    columns also support contains (a date) and overlaps (an interval).
+    """
+
+    def __init__(self, table: Table, query: dict):
+        self.table = table
+        self.schema = table.schema
+        columns = query.get("columns") or [field.name for field in self.schema.fields]
+        self.positions = [self.schema.position(column) for column in columns]
+        self.columns = ['id'] + list(columns)
+        self.projection = Schema([self.schema.fields[position] for position in self.positions])
+        self.where = query.get("where")
+        self.predicate = self._compile(self.where) if self.where else None
+        self.order_by = [self._order_term(term) for term in query.get("order_by") or []]
+        self.limit = query.get("limit")
+        if self.limit is not None and (not isinstance(self.limit, int) or self.limit < 0):
+            raise ValueError("Limit must be a non-negative integer.")
+
+    def execute(self):
+        # Candidates are collected under the table's read lock. Filtering,
+        # sorting and rendering then run on that copy without holding it.
+        with self.table.lock.read():
+            records = self._candidates()
+        if self.predicate is not None:
+            predicate = self.predicate
+            records = (record for record in records if predicate(record[1]))
+        if self.order_by:
+            if self.limit is not None:
+                records = heapq.nsmallest(self.limit, records, key=self._sort_key)
+            else:
+                records = sorted(records, key=self._sort_key)
+        elif self.limit is not None:
+            records = islice(records, self.limit)
+        rows = []
+        for _id, values in records:
+            rows.append([_id] + self.projection.render([values[position] for position in self.positions]))
+        return self.columns, rows
+
+    def _candidates(self):
+        # Uses an index for the first indexed condition of a top-level AND
+        # (or a lone condition) and falls back to a scan of every row.
+        conditions = self.where.get("and", [self.where]) if self.where else []
+        for condition in conditions:
+            column, op = condition.get("column"), condition.get("op")
+            index = self.table.indexes.get(column)
+            if index is None:
+                continue
+            if op == '=':
+                ids = index.lookup(self._coerce(column, condition["value"]))
+            elif op in RANGE_BOUNDS and index.kind == 'sorted':
+                low, high, include_low, include_high = RANGE_BOUNDS[op](self._coerce_operand(column, op, condition["value"]))
+                ids = index.range(low, high, include_low, include_high)
+            else:
+                continue
+            return self.table.fetch(ids)
+        return self.table.snapshot()
+
+    def _compile(self, node):
+        if not isinstance(node, dict):
+            raise ValueError(f"Invalid condition {node}.")
+        if "and" in node:
+            parts = [self._compile(part) for part in node["and"]]
+            return lambda values: all(part(values) for part in parts)
+        if "or" in node:
+            parts = [self._compile(part) for part in node["or"]]
+            return lambda values: any(part(values) for part in parts)
+        if "not" in node:
+            part = self._compile(node["not"])
+            return lambda values: not part(values)
+
+        column, op = node.get("column"), node.get("op")
+        position = self.schema.position(column)
+        operand = self._coerce_operand(column, op, node.get("value"))
+        if op in COMPARISONS:
+            compare = COMPARISONS[op]
+            return lambda values: compare(values[position], operand)
+        if op == 'between':
+            low, high = operand
+            return lambda values: low <= values[position] <= high
+        if op == 'in':
+            return lambda values: values[position] in operand
+        if op == 'contains':
+            return lambda values: values[position][0] <= operand <= values[position][1]
+        if op == 'overlaps':
+            start, end = operand
+            return lambda values: values[position][0] <= end and start <= values[position][1]
+        raise ValueError(f"Operator {op} is not supported.")
+
+    def _coerce_operand(self, column, op, value):
+        if op in ('between', 'in'):
+            if not isinstance(value, list) or (op == 'between' and len(value) != 2):
+                raise ValueError(f"Operator {op} needs a list of values.")
+            values = [self._coerce(column, item) for item in value]
+            return set(values) if op == 'in' else values
+        if op in ('contains', 'overlaps'):
+            if self.schema.fields[self.schema.position(column)].ftype != Type.DATEINVL:
+                raise ValueError(f"Operator {op} needs a DATEINVL column.")
+            parser = PARSERS[Type.DATE] if op == 'contains' else PARSERS[Type.DATEINVL]
+            try:
+                return parser(value)
+            except Exception as e:
+                raise TypeError(e)
+        return self._coerce(column, value)
+
+    def _coerce(self, column, value):
+        return self.schema.coerce_value(column, value)
+
+    def _order_term(self, term):
+        column, direction = (term, 'asc') if isinstance(term, str) else term
+        if direction not in ('asc', 'desc'):
+            raise ValueError(f"Sort direction {direction} is not supported.")
+        return self.schema.position(column), direction == 'desc'
+
+    def _sort_key(self, record):
+        values = record[1]
+        return tuple(
+            Descending(values[position]) if descending else values[position]
+            for position, descending in self.order_by
+        )
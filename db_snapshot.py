@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from db_classes import Type, COLUMN_CODECS
+
+
+# Layout: magic, header length, JSON header, then 8-byte aligned sections.
+# Numeric and date columns are fixed-width arrays, text columns and row ids
+# are string heaps made of an offsets array and a UTF-8 blob.
+MAGIC = b'LABSNAP1'
+PREFIX = struct.Struct('<8sI')
+
+
+class StringHeap:
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.data[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+
+class Snapshot:
+    def __init__(self, file_path):
+        with open(file_path, mode='rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = PREFIX.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a table snapshot.")
+        header = json.loads(self.mm[PREFIX.size:PREFIX.size + header_size])
+        self.types = header['types']
+        self.headers = header['headers']
+        self.swap = header['byteorder'] != sys.byteorder
+        self.base = _aligned(PREFIX.size + header_size)
+        self.view = memoryview(self.mm)
+        self.ids = self._section(header['ids'])
+        self.columns = [self._section(section) for section in header['columns']]
+
+    def decoded_columns(self):
+        for ftype, column in zip(self.types[1:], self.columns):
+            codec = COLUMN_CODECS.get(Type(ftype))
+            yield map(codec[2], column) if codec and codec[2] else column
+
+    def records(self):
+        return zip(self.ids, map(list, zip(*self.decoded_columns())))
+
+    def _section(self, section):
+        if section['kind'] == 'heap':
+            return StringHeap(self._array('q', section['offsets']), self.view[self._slice(section['data'])])
+        return self._array(section['kind'], section['data'])
+
+    def _array(self, typecode, span):
+        # Zero copy when the file was written on a machine with the same
+        # byte order, otherwise the section is copied and swapped.
+        view = self.view[self._slice(span)]
+        if not self.swap:
+            return view.cast(typecode)
+        values = array(typecode)
+        values.frombytes(view)
+        values.byteswap()
+        return values
+
+    def _slice(self, span):
+        return slice(self.base + span[0], self.base + span[0] + span[1])
+
+
+def read_snapshot_header(file_path):
+    with open(file_path, mode='rb') as file:
+        magic, header_size = PREFIX.unpack(file.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a table snapshot.")
+        header = json.loads(file.read(header_size))
+    return header['types'], header['headers']
+
+
+def write_snapshot(file_path, types, headers, records):
+    ids = []
+    columns = [[] for _ in types[1:]]
+    for _id, values in records:
+        ids.append(_id)
+        for column, value in zip(columns, values):
+            column.append(value)
+
+    sections = []
+    blobs = []
+    size = 0
+
+    def add_blob(blob):
+        nonlocal size
+        padding = -size % 8
+        blobs.append(b'\0' * padding + blob)
+        size += padding
+        span = [size, len(blob)]
+        size += len(blob)
+        return span
+
+    def add_heap(strings):
+        encoded = [value.encode('utf-8') for value in strings]
+        offsets = array('q', [0])
+        total = 0
+        for value in encoded:
+            total += len(value)
+            offsets.append(total)
+        return {'kind': 'heap', 'offsets': add_blob(offsets.tobytes()), 'data': add_blob(b''.join(encoded))}
+
+    id_section = add_heap(ids)
+    for ftype, column in zip(types[1:], columns):
+        codec = COLUMN_CODECS.get(Type(ftype))
+        if codec is None:
+            sections.append(add_heap(column))
+        else:
+            values = array(codec[0], map(codec[1], column) if codec[1] else column)
+            sections.append({'kind': codec[0], 'data': add_blob(values.tobytes())})
+
+    header = json.dumps({
+        'types': types,
+        'headers': headers,
+        'byteorder': sys.byteorder,
+        'ids': id_section,
+        'columns': sections,
+    }).encode('utf-8')
+    prefix = PREFIX.pack(MAGIC, len(header)) + header
+    with open(f'{file_path}.tmp', mode='wb') as file:
+        file.write(prefix + b'\0' * (-len(prefix) % 8))
+        for blob in blobs:
+            file.write(blob)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{file_path}.tmp', file_path)
+
+
+def _aligned(size):
+    return size + (-size % 8)
@@ -0,0 +1,171 @@
+import sys
+import json
+import struct
+from array import array
+from functools import lru_cache
+from itertools import accumulate
+
+from db_classes import Type, _parse_date, _render_date
+
+
+# Binary row batches. A batch is sent column by column: each column starts
+# with a kind byte and is stored in the most compact form its values allow,
+# so the layout is written once per batch instead of once per row.
+#
+#   marker, request id + 1 (0 when untagged), row count, column count,
+#   then per column: kind and payload
+#
+# Integers, dates and intervals are packed into the narrowest of 1, 2, 4 or
+# 8 byte little-endian arrays, reals into doubles, strings into a lengths
+# array and one UTF-8 blob. Anything else falls back to JSON. Rows of
+# uneven width are sent as a single JSON blob with a column count of 0.
+BATCH_MARKER = b'\x00'
+COUNTS = struct.Struct('<QII')
+BLOB_SIZE = struct.Struct('<I')
+
+KIND_INT = b'i'
+KIND_REAL = b'd'
+KIND_STRING = b's'
+KIND_DATE = b'D'
+KIND_INTERVAL = b'V'
+KIND_JSON = b'j'
+
+INT_TYPECODES = [
+    (typecode, -2 ** (8 * array(typecode).itemsize - 1), 2 ** (8 * array(typecode).itemsize - 1) - 1)
+    for typecode in 'bhiq'
+]
+
+render_date = lru_cache(maxsize=65536)(_render_date)
+
+
+@lru_cache(maxsize=65536)
+def date_ordinal(value):
+    # Only the zero-padded YYYY.MM.DD form survives a round trip through an
+    # ordinal unchanged, anything else is sent as a string.
+    if type(value) is str and len(value) == 10 and value[4] == '.' and value[7] == '.':
+        if (value[:4] + value[5:7] + value[8:]).isdigit():
+            return _parse_date(value)
+    return None
+
+
+def encode_batch(rows, types=None, request_id=None):
+    rows = list(rows)
+    tag = 0 if request_id is None else request_id + 1
+    width = len(rows[0]) if rows else 0
+    if width == 0 or len(set(map(len, rows))) != 1:
+        return BATCH_MARKER + COUNTS.pack(tag, len(rows), 0) + _blob(json.dumps(rows).encode('utf-8'))
+
+    parts = [BATCH_MARKER + COUNTS.pack(tag, len(rows), width)]
+    for index, column in enumerate(zip(*rows)):
+        ftype = Type(types[index]) if types and index < len(types) else None
+        parts.append(_encode_column(column, ftype))
+    return b''.join(parts)
+
+
+def retag_batch(payload, request_id=None):
+    _, row_count, column_count = COUNTS.unpack_from(payload, len(BATCH_MARKER))
+    tag = 0 if request_id is None else request_id + 1
+    return BATCH_MARKER + COUNTS.pack(tag, row_count, column_count) + payload[len(BATCH_MARKER) + COUNTS.size:]
+
+
+def decode_batch(payload):
+    tag, row_count, column_count = COUNTS.unpack_from(payload, len(BATCH_MARKER))
+    view = memoryview(payload)
+    position = len(BATCH_MARKER) + COUNTS.size
+    if column_count == 0:
+        rows, _ = _read_json(view, position)
+    else:
+        columns = []
+        for _ in range(column_count):
+            column, position = _decode_column(view, position, row_count)
+            columns.append(column)
+        rows = list(map(list, zip(*columns)))
+    frame = {"chunk": rows}
+    if tag:
+        frame["id"] = tag - 1
+    return frame
+
+
+def _encode_column(column, ftype):
+    if ftype == Type.DATE:
+        ordinals = list(map(date_ordinal, column))
+        if None not in ordinals:
+            return KIND_DATE + _int_array(ordinals)
+    if ftype == Type.DATEINVL and all(type(value) is str and len(value) == 21 for value in column):
+        starts = [date_ordinal(value[:10]) for value in column]
+        ends = [date_ordinal(value[11:]) for value in column]
+        if None not in starts and None not in ends:
+            return KIND_INTERVAL + _int_array(starts) + _int_array(ends)
+
+    kinds = set(map(type, column))
+    if kinds == {int} and INT_TYPECODES[-1][1] <= min(column) and max(column) <= INT_TYPECODES[-1][2]:
+        return KIND_INT + _int_array(column)
+    if kinds == {float}:
+        return KIND_REAL + _array_bytes(array('d', column))
+    if kinds == {str}:
+        lengths = array('I', map(len, column))
+        return KIND_STRING + _array_bytes(lengths) + _blob(''.join(column).encode('utf-8', 'surrogatepass'))
+    return KIND_JSON + _blob(json.dumps(column).encode('utf-8'))
+
+
+def _decode_column(view, position, row_count):
+    kind = bytes(view[position:position + 1])
+    position += 1
+    if kind == KIND_INT:
+        return _read_int_array(view, position, row_count)
+    if kind == KIND_DATE:
+        ordinals, position = _read_int_array(view, position, row_count)
+        return list(map(render_date, ordinals)), position
+    if kind == KIND_INTERVAL:
+        starts, position = _read_int_array(view, position, row_count)
+        ends, position = _read_int_array(view, position, row_count)
+        return [f'{render_date(start)}-{render_date(end)}' for start, end in zip(starts, ends)], position
+    if kind == KIND_REAL:
+        return _read_array(view, position, 'd', row_count)
+    if kind == KIND_STRING:
+        lengths, position = _read_array(view, position, 'I', row_count)
+        size, = BLOB_SIZE.unpack_from(view, position)
+        position += BLOB_SIZE.size
+        text = str(view[position:position + size], 'utf-8', 'surrogatepass')
+        offsets = list(accumulate(lengths, initial=0))
+        return [text[start:end] for start, end in zip(offsets, offsets[1:])], position + size
+    if kind == KIND_JSON:
+        return _read_json(view, position)
+    raise ValueError(f"Unknown column kind {kind!r}.")
+
+
+def _int_array(values):
+    low, high = min(values, default=0), max(values, default=0)
+    for typecode, minimum, maximum in INT_TYPECODES:
+        if minimum <= low and high <= maximum:
+            return typecode.encode('ascii') + _array_bytes(array(typecode, values))
+
+
+def _read_int_array(view, position, row_count):
+    typecode = str(view[position:position + 1], 'ascii')
+    return _read_array(view, position + 1, typecode, row_count)
+
+
+def _array_bytes(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _read_array(view, position, typecode, row_count):
+    values = array(typecode)
+    end = position + values.itemsize * row_count
+    values.frombytes(view[position:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist(), end
+
+
+def _blob(data):
+    return BLOB_SIZE.pack(len(data)) + data
+
+
+def _read_json(view, position):
+    size, = BLOB_SIZE.unpack_from(view, position)
+    position += BLOB_SIZE.size
+    return json.loads(str(view[position:position + size], 'utf-8')), position + size
@@ -1,7 +1,29 @@
+import json
+import time
+import select
 import socket
 import threading
-import json
+from db_cache import ResponseCache
 from db_manager import DbManager
+from db_metrics import METRICS
+from db_protocol import (
+    HEADER, encode_message, send_message, recv_frame, decode_payload, stream_frames, replay_frames,
+    negotiate_encoding, negotiate_compression,
+)
+
+
+# Read actions whose rows are kept encoded in the response cache.
+CACHED_ACTIONS = ('select_table', 'get_table_data', 'query')
+# How often an idle subscription checks whether its client went away.
+FEED_POLL_INTERVAL = 1.0
+
+
+def request_rows(data: dict):
+    # Rows changed by a request whose reply is not streamed.
+    for key in ("rows", "updates", "ids"):
+        if isinstance(data.get(key, None), (list, dict)):
+            return len(data[key])
+    return 1 if "_id" in data or "values" in data else 0
 
 
 class DbServer:
@@ -9,101 +31,313 @@ class DbServer:
         self.dbm: DbManager = DbManager()
         self.host = '127.0.0.1'
         self.port = 9001
+        self.load_mode = 'lazy'
+        self.cache = ResponseCache()
+        self.metrics = METRICS
 
     def handle_client(self, client_socket: socket.socket):
+        session = {"encoding": 'json', "compression": None}
+        self.metrics.connection_opened('socket')
         while True:
+            request_data, tally = None, {}
             try:
-                request = client_socket.recv(1024).decode('utf-8')
-                if not request:
+                frame = recv_frame(client_socket)
+                if frame is None:
                     break
+                start = time.perf_counter()
+                request_data = self.decode_request(frame)
 
-                request_data = json.loads(request)
-                action = request_data.get("action")
-                data: dict = request_data.get("data")
-
-                if action == "select_table":
-                    db_name, table_name = data.get("db_name", None), data.get("table_name", None)
-                    if None not in (db_name, table_name):
-                        _, columns, rows = self.dbm.get_table_data(db_name, table_name)
-                        response = {"columns": columns, "rows": [[key]+row.values for key, row in rows.items()]}
-
-                elif action == "insert_row":
-                    db_name, table_name, values = data.get("db_name", None), data.get("table_name", None), data.get("values", None)
-                    if None not in (db_name, table_name, values):
-                        self.dbm.insert_row(db_name, table_name, values)
-                        response = {"status": "Record inserted"}
-
-                elif action == "update_row":
-                    db_name, table_name, values, _id = data.get("db_name", None), data.get("table_name", None), data.get("values", None), data.get("_id", None)
-                    if None not in (db_name, table_name, values, _id):
-                        self.dbm.update_row(db_name, table_name, _id, values)
-                        response = {"status": "Record updated"}
-
-                elif action == "delete_row":
-                    db_name, table_name, _id = data.get("db_name", None), data.get("table_name", None), data.get("_id", None)
-                    if None not in (db_name, table_name, _id):
-                        self.dbm.delete_row(db_name, table_name, _id)
-                        response = {"status": "Record deleted"}
-
-                elif action == "delete_table":
-                    db_name, table_name = data.get("db_name", None), data.get("table_name", None)
-                    if None not in (db_name, table_name):
-                        self.dbm.delete_table(db_name, table_name)
-                    response = {"status": "Record deleted"}
-
-                elif action == "drop_database":
-                    db_name = data.get("db_name", None)
-                    if db_name:
-                        self.dbm.drop_database(db_name)
-                    response = {"status": "Database deleted"}
-
-                elif action == "create_table":
-                    db_name, table_name, columns = data.get("db_name", None), data.get("table_name", None), data.get("columns", None)
-                    if None not in (db_name, table_name, columns):
-                        self.dbm.create_table(db_name, table_name, columns)
-                    response = {"status": "Table created"}
-
-                elif action == "create_database":
-                    db_name = data.get("db_name", None)
-                    if db_name:
-                        self.dbm.create_database(db_name)
-                    response = {"status": "Datbase created"}
-
-                elif action == 'fetch_table_data':
-                    db_name, table_name = data.get("db_name", None), data.get("table_name", None)
-                    if None not in (db_name, table_name):
-                        types, headers, rows = self.dbm._fetch_table_data(db_name, table_name)
-                        response = {"types": types, "headers": headers, "rows": rows}
-
-                elif action == 'get_table_data':
-                    db_name, table_name = data.get("db_name", None), data.get("table_name", None)
-                    if None not in (db_name, table_name):
-                        types, columns, rows = self.dbm.get_table_data(db_name, table_name)
-                        response = {"types": types, "columns": columns, "rows": rows}
-
-                elif action == 'fetch_databases_and_tables':
-                    databases = self.dbm.fetch_databases_and_tables()
-                    response = {"databases": databases}
-
-                elif action == 'delete_repeated':
-                    db_name, table_name = data.get("db_name", None), data.get("table_name", None)
-                    if None not in (db_name, table_name):
-                        num = self.dbm.delete_repeated(db_name, table_name)
-                        response = {"num": num}
-
+                if request_data.get("action") == "hello":
+                    # Encoding and compression are properties of the
+                    # connection, so the handshake is answered here and not
+                    # in dispatch. The reply goes out before they apply.
+                    response = self.handshake(request_data.get("data"))
+                    if "id" in request_data:
+                        response["id"] = request_data["id"]
+                    frames = [response]
+                elif request_data.get("action") == "subscribe":
+                    # The connection only carries change events from here on.
+                    self.push_changes(client_socket, request_data, session["compression"])
+                    break
                 else:
-                    response = {"error": "Unknown action"}
+                    frames = self.respond(request_data, session)
 
-                client_socket.send(json.dumps(response).encode('utf-8'))
+                for data in self.encoded_frames(frames, session["compression"], tally):
+                    client_socket.sendall(data)
+                self.record(request_data, time.perf_counter() - start, tally)
+                if request_data.get("action") == "hello":
+                    session = {"encoding": response["encoding"], "compression": response["compression"]}
 
             except Exception as e:
-                client_socket.send(json.dumps({"error": str(e)}).encode('utf-8'))
+                if isinstance(request_data, dict):
+                    self.record(request_data, time.perf_counter() - start, {**tally, "error": str(e)})
+                try:
+                    send_message(client_socket, {"error": str(e)})
+                except OSError:
+                    pass
                 break
 
+        self.metrics.connection_closed('socket')
         client_socket.close()
 
+    def decode_request(self, frame):
+        payload, compressed = frame
+        self.metrics.add_bytes('socket', received=HEADER.size + len(payload))
+        with self.metrics.phase('deserialize'):
+            return decode_payload(payload, compressed)
+
+    def encoded_frames(self, frames, compression=None, tally=None):
+        # Encodes the frames of a reply one at a time. Producing a frame and
+        # encoding it both count as serialization. tally, if given, collects
+        # the row count of a streamed reply and any error it carried.
+        frames = iter(frames)
+        while True:
+            start = time.perf_counter()
+            frame = next(frames, None)
+            if frame is None:
+                return
+            data = encode_message(frame, compression)
+            self.metrics.observe_phase('serialize', time.perf_counter() - start)
+            self.metrics.add_bytes('socket', sent=len(data))
+            if tally is not None and isinstance(frame, dict):
+                if "error" in frame:
+                    tally["error"] = frame["error"]
+                elif frame.get("end", False):
+                    tally["rows"] = frame["count"]
+            yield data
+
+    def record(self, request_data: dict, seconds, tally: dict):
+        data = request_data.get("data")
+        data = data if isinstance(data, dict) else {}
+        action = request_data.get("action")
+        # Unknown actions share one label, so clients can not add new series.
+        if not isinstance(action, str) or tally.get("error") == "Unknown action":
+            action = 'unknown'
+        self.metrics.observe_request(
+            'socket', action, seconds, tally.get("rows", request_rows(data)), "error" in tally,
+            data.get("db_name", None), data.get("table_name", None),
+        )
+
+    def push_changes(self, client_socket: socket.socket, request_data: dict, compression=None):
+        # Sends an acknowledgement, then one frame per change event until the
+        # client closes the connection or sends anything else.
+        data = request_data.get("data") or {}
+        tag = {"id": request_data["id"]} if "id" in request_data else {}
+        subscription = self.dbm.feed.subscribe(data.get("db_name", None), data.get("table_name", None))
+        try:
+            send_message(client_socket, {**tag, "status": "subscribed"}, compression)
+            while True:
+                event = subscription.get(timeout=FEED_POLL_INTERVAL)
+                if event is not None:
+                    send_message(client_socket, {**tag, **event}, compression)
+                elif select.select([client_socket], [], [], 0)[0]:
+                    break
+        except OSError:
+            pass
+        finally:
+            subscription.close()
+
+    def handshake(self, data: dict):
+        return {"encoding": negotiate_encoding(data), "compression": negotiate_compression(data)}
+
+    def respond(self, request_data: dict, session: dict):
+        # Runs one request and returns the frames of its reply. Rows of the
+        # cached actions are kept as encoded chunks, keyed by the version of
+        # the table they were read from, so asking again before the table
+        # changes skips both the manager and the encoder.
+        tag = {"id": request_data["id"]} if "id" in request_data else {}
+        key = self._cache_key(request_data, session["encoding"])
+        if key is not None and (entry := self.cache.get(key)) is not None:
+            header, chunks = entry
+            return replay_frames({**header, **tag}, chunks, session["encoding"])
+
+        response, stream = self.dispatch(request_data)
+        response.update(tag)
+        if stream is None:
+            return [response]
+        if key is None:
+            return stream_frames(response, stream, encoding=session["encoding"])
+        return self._caching_frames(key, response, stream, session["encoding"])
+
+    def _cache_key(self, request_data: dict, encoding):
+        data = request_data.get("data")
+        if request_data.get("action") not in CACHED_ACTIONS or not isinstance(data, dict):
+            return None
+        try:
+            version = self.dbm.table_version(data.get("db_name", None), data.get("table_name", None))
+        except KeyError:
+            return None
+        return request_data["action"], version, json.dumps(data, sort_keys=True, default=str), encoding
+
+    def _caching_frames(self, key, response: dict, stream, encoding):
+        # Chunks are collected while they are sent and cached once the reply
+        # went out whole. A reply too big to cache is dropped chunk by chunk.
+        header = {k: v for k, v in response.items() if k != "id"}
+        chunks, size = [], 0
+        for frame in stream_frames(response, stream, encoding=encoding, sink=chunks):
+            yield frame
+            if isinstance(frame, bytes):
+                size += len(frame)
+                if size > self.cache.max_entry_bytes:
+                    chunks.clear()
+        if size <= self.cache.max_entry_bytes:
+            self.cache.put(key, (header, chunks), size)
+
+    def dispatch(self, request_data: dict):
+        # Runs one request against the manager. Returns the reply and, for
+        # actions that produce rows, an iterable of rows to stream after it.
+        action = request_data.get("action")
+        data: dict = request_data.get("data")
+        stream = None
+
+        if action == "select_table":
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                _, columns, rows, _ = self.dbm.iter_table_page(db_name, table_name)
+                response = {"columns": columns}
+                stream = rows
+
+        elif action == "insert_row":
+            db_name, table_name, values = data.get("db_name", None), data.get("table_name", None), data.get("values", None)
+            if None not in (db_name, table_name, values):
+                _id = self.dbm.insert_row(db_name, table_name, values, data.get("durability", None))
+                response = {"status": "Record inserted", "_id": _id}
+
+        elif action == "update_row":
+            db_name, table_name, values, _id = data.get("db_name", None), data.get("table_name", None), data.get("values", None), data.get("_id", None)
+            if None not in (db_name, table_name, values, _id):
+                self.dbm.update_row(db_name, table_name, _id, values, data.get("durability", None))
+                response = {"status": "Record updated"}
+
+        elif action == "delete_row":
+            db_name, table_name, _id = data.get("db_name", None), data.get("table_name", None), data.get("_id", None)
+            if None not in (db_name, table_name, _id):
+                self.dbm.delete_row(db_name, table_name, _id, data.get("durability", None))
+                response = {"status": "Record deleted"}
+
+        elif action == "insert_rows":
+            db_name, table_name, rows = data.get("db_name", None), data.get("table_name", None), data.get("rows", None)
+            if None not in (db_name, table_name, rows):
+                ids = self.dbm.insert_rows(db_name, table_name, rows, data.get("durability", None))
+                response = {"status": "Records inserted", "ids": ids}
+
+        elif action == "update_rows":
+            db_name, table_name, updates = data.get("db_name", None), data.get("table_name", None), data.get("updates", None)
+            if None not in (db_name, table_name, updates):
+                self.dbm.update_rows(db_name, table_name, updates, data.get("durability", None))
+                response = {"status": "Records updated"}
+
+        elif action == "delete_rows":
+            db_name, table_name, ids = data.get("db_name", None), data.get("table_name", None), data.get("ids", None)
+            if None not in (db_name, table_name, ids):
+                self.dbm.delete_rows(db_name, table_name, ids, data.get("durability", None))
+                response = {"status": "Records deleted"}
+
+        elif action == "delete_table":
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                self.dbm.delete_table(db_name, table_name)
+            response = {"status": "Record deleted"}
+
+        elif action == "drop_database":
+            db_name = data.get("db_name", None)
+            if db_name:
+                self.dbm.drop_database(db_name)
+            response = {"status": "Database deleted"}
+
+        elif action == "create_table":
+            db_name, table_name, columns = data.get("db_name", None), data.get("table_name", None), data.get("columns", None)
+            if None not in (db_name, table_name, columns):
+                self.dbm.create_table(db_name, table_name, columns, data.get("storage", "row"))
+            response = {"status": "Table created"}
+
+        elif action == "create_database":
+            db_name = data.get("db_name", None)
+            if db_name:
+                self.dbm.create_database(db_name)
+            response = {"status": "Datbase created"}
+
+        elif action == 'fetch_table_data':
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                types, headers, rows = self.dbm._fetch_table_data(db_name, table_name)
+                response = {"types": types, "headers": headers}
+                stream = rows
+
+        elif action == 'get_table_data':
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                types, columns, rows, cursor = self.dbm.iter_table_page(
+                    db_name, table_name, data.get("offset", 0), data.get("limit", None), data.get("cursor", None)
+                )
+                response = {"types": types, "columns": columns, "cursor": cursor}
+                stream = rows
+
+        elif action == 'create_index':
+            db_name, table_name, column = data.get("db_name", None), data.get("table_name", None), data.get("column", None)
+            if None not in (db_name, table_name, column):
+                self.dbm.create_index(db_name, table_name, column, data.get("kind", "hash"))
+                response = {"status": "Index created"}
+
+        elif action == 'drop_index':
+            db_name, table_name, column = data.get("db_name", None), data.get("table_name", None), data.get("column", None)
+            if None not in (db_name, table_name, column):
+                self.dbm.drop_index(db_name, table_name, column)
+                response = {"status": "Index dropped"}
+
+        elif action == 'lookup':
+            db_name, table_name, column, value = data.get("db_name", None), data.get("table_name", None), data.get("column", None), data.get("value", None)
+            if None not in (db_name, table_name, column, value):
+                rows = self.dbm.lookup_rows(db_name, table_name, column, value)
+                response = {}
+                stream = ([key] + values for key, values in rows.items())
+
+        elif action == 'range_lookup':
+            db_name, table_name, column = data.get("db_name", None), data.get("table_name", None), data.get("column", None)
+            if None not in (db_name, table_name, column):
+                rows = self.dbm.range_rows(
+                    db_name, table_name, column, data.get("low", None), data.get("high", None),
+                    data.get("include_low", True), data.get("include_high", True),
+                )
+                response = {}
+                stream = ([key] + values for key, values in rows.items())
+
+        elif action == 'query':
+            db_name, table_name, query = data.get("db_name", None), data.get("table_name", None), data.get("query", None)
+            if None not in (db_name, table_name, query):
+                columns, rows = self.dbm.query(db_name, table_name, query)
+                response = {"columns": columns}
+                stream = rows
+
+        elif action == 'set_dedup':
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                self.dbm.set_dedup(db_name, table_name, data.get("mode", None))
+                response = {"status": "Dedup mode set"}
+
+        elif action == 'ping':
+            response = {"status": "ok"}
+
+        elif action == 'stats':
+            response = {"metrics": self.metrics.render()}
+
+        elif action == 'fetch_databases_and_tables':
+            databases = self.dbm.fetch_databases_and_tables()
+            response = {"databases": databases}
+
+        elif action == 'delete_repeated':
+            db_name, table_name = data.get("db_name", None), data.get("table_name", None)
+            if None not in (db_name, table_name):
+                num = self.dbm.delete_repeated(db_name, table_name, data.get("durability", None))
+                response = {"num": num}
+
+        else:
+            response = {"error": "Unknown action"}
+
+        return response, stream
+
     def start_server(self):
-        self.dbm.load()
+        self.dbm.load(self.load_mode)
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.bind((self.host, self.port))
         server.listen(5)
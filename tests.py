@@ -1,18 +1,44 @@
+import os
+import json
+import zlib
+import asyncio
+import socket
+import tempfile
+import threading
 import unittest
+from datetime import date
+from unittest import mock
 
-from db_classes import Database, Type, Field, Schema
+from db_classes import Database, Type, Field, Schema, ValidationError
 from db_manager import DbManager
+from server import DbServer
+from db_metrics import Metrics
+from async_server import AsyncDbServer
+from db_protocol import encode_message, read_message
+from client import DbClient
+from async_client import AsyncDbClient
+
+try:
+    from fastapi.testclient import TestClient
+    import db_api
+except ImportError:
+    db_api = None
 
 
 class TestDbManager(unittest.TestCase):
     def setUp(self):
-        self.db_manager = DbManager()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name)
         self.db_manager.databases['test_db'] = Database('test_db')
 
         fields = [Field(name="name", ftype=Type.STRING), Field(name="age", ftype=Type.INT)]
         schema = Schema(fields)
         self.db_manager.databases['test_db'].create_table('test_table', schema)
 
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
     def test_insert_row(self):
         _id = self.db_manager.insert_row('test_db', 'test_table', ['John', 25])
         table = self.db_manager.databases['test_db'].tables['test_table']
@@ -29,6 +55,74 @@ class TestDbManager(unittest.TestCase):
         self.assertNotIn(_id1, table.rows)
         self.assertIn(_id2, table.rows)
 
+    def test_batch_operations(self):
+        ids = self.db_manager.insert_rows('test_db', 'test_table', [['John', 25], ['Jane', 30], ['Jack', 35]])
+        self.db_manager.update_rows('test_db', 'test_table', {ids[0]: ['John', 26]})
+        self.db_manager.delete_rows('test_db', 'test_table', ids[1:])
+
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(list(table.rows), ids[:1])
+        self.assertEqual(table.rows[ids[0]].values, ['John', 26])
+
+    def test_batch_is_atomic(self):
+        with self.assertRaises(TypeError):
+            self.db_manager.insert_rows('test_db', 'test_table', [['John', 25], ['Jane', 'thirty']])
+        with self.assertRaises(IndexError):
+            self.db_manager.delete_rows('test_db', 'test_table', ['missing'])
+
+    def test_batch_reports_every_bad_row(self):
+        with self.assertRaises(ValidationError) as context:
+            self.db_manager.insert_rows('test_db', 'test_table', [['John', 'x'], ['Jane', 30], ['Jack', 'y']])
+        self.assertEqual([error[:2] for error in context.exception.errors], [(0, 'age'), (2, 'age')])
+
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(len(table.rows), 0)
+
+    def test_table_pages(self):
+        ids = self.db_manager.insert_rows('test_db', 'test_table', [[f'name-{i}', i] for i in range(10)])
+
+        _, _, rows, cursor = self.db_manager.get_table_page('test_db', 'test_table', offset=2, limit=3)
+        self.assertEqual(list(rows), ids[2:5])
+
+        self.db_manager.delete_rows('test_db', 'test_table', ids[:2])
+        _, _, rows, cursor = self.db_manager.get_table_page('test_db', 'test_table', limit=4, cursor=cursor)
+        self.assertEqual(list(rows), ids[5:9])
+        _, _, rows, cursor = self.db_manager.get_table_page('test_db', 'test_table', limit=4, cursor=cursor)
+        self.assertEqual(list(rows), ids[9:])
+        self.assertIsNone(cursor)
+
+    def test_streamed_pages_and_versions(self):
+        ids = self.db_manager.insert_rows('test_db', 'test_table', [[f'name-{i}', i] for i in range(10)])
+        version = self.db_manager.table_version('test_db', 'test_table')
+
+        _, columns, rows, cursor = self.db_manager.iter_table_page('test_db', 'test_table', limit=4)
+        self.assertEqual(columns, ['id', 'name', 'age'])
+        self.assertEqual(list(rows), [[_id, f'name-{i}', i] for i, _id in enumerate(ids[:4])])
+        self.assertEqual(cursor, self.db_manager.get_table_page('test_db', 'test_table', limit=4)[3])
+        self.assertEqual(self.db_manager.table_version('test_db', 'test_table'), version)
+
+        self.db_manager.update_row('test_db', 'test_table', ids[0], ['John', 25])
+        self.assertNotEqual(self.db_manager.table_version('test_db', 'test_table'), version)
+
+    def test_lagging_subscriber_resyncs(self):
+        subscription = self.db_manager.feed.subscribe('test_db', maxsize=1)
+        self.db_manager.insert_row('test_db', 'test_table', ['John', 25])
+        self.db_manager.insert_row('test_db', 'test_table', ['Jane', 30])
+        self.assertEqual(subscription.get_nowait(), {"resync": True})
+        self.assertIsNone(subscription.get_nowait())
+
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['Joe', 35])
+        self.assertEqual(subscription.get_nowait()["changes"], [['I', _id, ['Joe', 35]]])
+        subscription.close()
+        self.assertFalse(self.db_manager.feed.subscriptions)
+
+    def test_values_are_typed(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(table.rows[_id].values, ['John', 25])
+        with self.assertRaises(TypeError):
+            self.db_manager.update_row('test_db', 'test_table', _id, ['John', 'old'])
+
     def test_delete_repeated(self):
         self.db_manager.insert_row('test_db', 'test_table', ['John', 25])
         self.db_manager.insert_row('test_db', 'test_table', ['John', 25])
@@ -40,6 +134,658 @@ class TestDbManager(unittest.TestCase):
         self.assertEqual(deleted_count, 1)
         self.assertEqual(len(table.rows), 2)
 
+    def test_dedup_modes(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', 25])
+        self.db_manager.set_dedup('test_db', 'test_table', 'track')
+        self.db_manager.insert_rows('test_db', 'test_table', [['John', 25], ['John', 25], ['Jane', 30]])
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(len(table.duplicates()), 2)
+
+        self.assertEqual(self.db_manager.delete_repeated('test_db', 'test_table'), 2)
+        self.assertIn(_id, table.rows)
+        self.assertEqual(table.duplicates(), [])
+
+        self.db_manager.set_dedup('test_db', 'test_table', 'reject')
+        with self.assertRaises(ValueError):
+            self.db_manager.insert_row('test_db', 'test_table', ['Jane', 30])
+        self.assertEqual(len(table.rows), 2)
+
+
+class TestTableLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.create_table('test_db', 'test_table', 'name:STRING,age:INT')
+
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
+    def reload(self):
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load()
+        self.addCleanup(db_manager.close)
+        return db_manager.databases['test_db'].tables['test_table']
+
+    def test_replay_on_load(self):
+        _id1 = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        _id2 = self.db_manager.insert_row('test_db', 'test_table', ['Jane', '30'])
+        self.db_manager.update_row('test_db', 'test_table', _id1, ['John', '26'])
+        self.db_manager.delete_row('test_db', 'test_table', _id2)
+
+        table = self.reload()
+        self.assertEqual(list(table.rows), [_id1])
+        self.assertEqual(table.rows[_id1].values, ['John', 26])
+
+    def test_writer_racing_a_recreated_table(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        write = table.lock.write
+        raced = []
+
+        def drop_and_recreate():
+            # Another thread deletes and creates the table again while the
+            # writer waits on the old table's lock.
+            if not raced:
+                raced.append(True)
+                self.db_manager.delete_table('test_db', 'test_table')
+                self.db_manager.create_table('test_db', 'test_table', 'name:STRING,age:INT')
+            return write()
+
+        with mock.patch.object(table.lock, 'write', drop_and_recreate):
+            with self.assertRaises(ValueError):
+                self.db_manager.update_row('test_db', 'test_table', _id, ['John', '26'])
+        self.assertEqual(len(self.db_manager.databases['test_db'].tables['test_table'].rows), 0)
+        self.db_manager.close()
+        self.assertEqual(len(self.reload().rows), 0)
+
+    def test_fetch_table_data_sees_the_log(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        types, headers, rows = self.db_manager._fetch_table_data('test_db', 'test_table')
+        self.assertEqual((types, headers), (['ID', 'STRING', 'INT'], ['id', 'name', 'age']))
+        self.assertEqual(rows, [[_id, 'John', 25]])
+
+    def test_unknown_names_are_not_added(self):
+        with self.assertRaises(KeyError):
+            self.db_manager.table_version('no_db', 'test_table')
+        with self.assertRaises(KeyError):
+            self.db_manager.lookup_rows('no_db', 'test_table', 'name', 'John')
+        self.assertNotIn('no_db', self.db_manager.databases)
+
+    def test_id_columns(self):
+        self.db_manager.create_table('test_db', 'refs', 'ref:ID,age:INT')
+        _id = self.db_manager.insert_row('test_db', 'refs', ['abc', '1'])
+        self.db_manager.close()
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.load()
+        self.assertEqual(self.db_manager.get_table_data('test_db', 'refs')[2], {_id: ['abc', 1]})
+
+    def test_dates_before_year_1000(self):
+        self.db_manager.create_table('test_db', 'dates', 'born:DATE,stay:DATEINVL')
+        row = ['0999.01.01', '0099.12.31-0100.01.01']
+        _id = self.db_manager.insert_row('test_db', 'dates', row)
+        self.assertEqual(self.db_manager.get_table_data('test_db', 'dates')[2][_id], row)
+        self.db_manager.compact('test_db', 'dates')
+        self.db_manager.insert_row('test_db', 'dates', row)
+        self.db_manager.close()
+
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.load()
+        self.assertEqual(list(self.db_manager.get_table_data('test_db', 'dates')[2].values()), [row, row])
+
+    def test_recovery_from_interrupted_compaction_and_torn_append(self):
+        _id1 = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        _id2 = self.db_manager.insert_row('test_db', 'test_table', ['Jane', '30'])
+        self.db_manager.compact('test_db', 'test_table')
+        self.db_manager.update_row('test_db', 'test_table', _id1, ['John', '26'])
+        self.db_manager.delete_row('test_db', 'test_table', _id1)
+        # Crash after the new snapshot was written but before the rotated
+        # log was discarded, then in the middle of the next append.
+        with mock.patch('db_log.TableLog.discard_rotated'):
+            self.db_manager.compact('test_db', 'test_table')
+        self.db_manager.close()
+        with open(f'{self.tmp_dir.name}/test_db-test_table.log', 'a', encoding='utf-8') as file:
+            file.write('I,abc,y')
+
+        # The reload finishes the compaction in the background, so it is
+        # closed before the files are opened again.
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.load()
+        self.assertEqual(list(self.db_manager.databases['test_db'].tables['test_table'].rows), [_id2])
+        _id3 = self.db_manager.insert_row('test_db', 'test_table', ['Jim', '40'])
+        self.db_manager.close()
+        self.assertEqual(list(self.reload().rows), [_id2, _id3])
+
+    def test_catalog(self):
+        self.db_manager.create_database('empty_db')
+        self.db_manager.create_table('other_db', 'other_table', 'born:DATE')
+        self.db_manager.delete_table('other_db', 'other_table')
+
+        with mock.patch('os.listdir', side_effect=AssertionError):
+            databases = self.db_manager.fetch_databases_and_tables()
+        self.assertEqual(databases, {'test_db': ['test_table'], 'empty_db': [], 'other_db': []})
+
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load()
+        self.addCleanup(db_manager.close)
+        self.assertEqual(db_manager.fetch_databases_and_tables(), databases)
+
+    def test_lazy_and_parallel_load(self):
+        ids = self.db_manager.insert_rows('test_db', 'test_table', [['John', 25], ['Jane', 30]])
+        self.db_manager.create_table('test_db', 'other_table', 'born:DATE')
+        self.db_manager.compact('test_db', 'test_table')
+        self.db_manager.update_row('test_db', 'test_table', ids[1], ['Jane', 31])
+
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load('lazy')
+        self.addCleanup(db_manager.close)
+        table = db_manager.databases['test_db'].tables['test_table']
+        self.assertFalse(table.is_loaded)
+        self.assertEqual(table.rows[ids[1]].values, ['Jane', 31])
+        self.assertTrue(table.is_loaded)
+
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load('parallel', workers=2)
+        self.addCleanup(db_manager.close)
+        self.assertEqual(db_manager.get_table_data('test_db', 'test_table')[2], {ids[0]: ['John', 25], ids[1]: ['Jane', 31]})
+        self.assertIn('other_table', db_manager.databases['test_db'].tables)
+
+    def test_concurrent_writers_and_readers(self):
+        def write(n):
+            for i in range(50):
+                self.db_manager.insert_rows('test_db', 'test_table', [[f'name-{n}-{i}', i]])
+
+        sizes = [[], []]
+
+        def read(seen):
+            for _ in range(50):
+                seen.append(len(self.db_manager.get_table_data('test_db', 'test_table')[2]))
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        threads += [threading.Thread(target=read, args=(seen,)) for seen in sizes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for seen in sizes:
+            self.assertEqual(seen, sorted(seen))
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertIs(table.snapshot(), table.snapshot())
+        self.assertEqual(len(self.reload().rows), 200)
+
+    def test_durability_levels(self):
+        with mock.patch('db_log.os.fsync') as fsync:
+            self.db_manager.insert_row('test_db', 'test_table', ['John', 25], 'sync')
+            self.assertEqual(fsync.call_count, 1)
+            self.db_manager.insert_row('test_db', 'test_table', ['Jane', 30], 'async')
+            self.assertEqual(fsync.call_count, 1)
+
+            def write(n):
+                for i in range(10):
+                    self.db_manager.insert_row('test_db', 'test_table', [f'name-{n}', i], 'batched')
+
+            threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLess(fsync.call_count, 80)
+
+        with self.assertRaises(ValueError):
+            self.db_manager.insert_row('test_db', 'test_table', ['John', 25], 'never')
+        self.assertEqual(len(self.reload().rows), 82)
+
+    def test_compact(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', '25'])
+        self.db_manager.compact('test_db', 'test_table')
+
+        self.assertFalse(os.path.exists(f'{self.tmp_dir.name}/test_db-test_table.log'))
+        self.assertEqual(self.reload().rows[_id].values, ['John', 25])
+
+
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.create_table(
+            'test_db', 'test_table', 'name:STRING,age:INT,score:REAL,born:DATE,stay:DATEINVL', storage='columnar'
+        )
+
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        _id1 = self.db_manager.insert_row('test_db', 'test_table', ['John', '25', '1.5', '2000.01.02', '2020.01.01-2020.02.01'])
+        _id2 = self.db_manager.insert_row('test_db', 'test_table', ['Jane', '30', '2.5', '1995.05.06', '2021.01.01-2021.03.01'])
+        self.db_manager.update_row('test_db', 'test_table', _id1, ['John', '26', '1.5', '2000.01.02', '2020.01.01-2020.02.01'])
+        self.db_manager.delete_row('test_db', 'test_table', _id2)
+
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        born = date(2000, 1, 2).toordinal()
+        self.assertEqual(table.rows[_id1].values[:4], ['John', 26, 1.5, born])
+        self.assertEqual(list(table.rows.column(3)), [born])
+
+        self.db_manager.compact('test_db', 'test_table')
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load()
+        self.addCleanup(db_manager.close)
+        table = db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(table.storage, 'columnar')
+        _, _, rows = db_manager.get_table_data('test_db', 'test_table')
+        self.assertEqual(rows, {_id1: ['John', 26, 1.5, '2000.01.02', '2020.01.01-2020.02.01']})
+        # Full reads of a columnar table do not keep a copy of its rows.
+        db_manager.query('test_db', 'test_table', {"where": {"column": "age", "op": ">", "value": 0}})
+        self.assertIsNone(table._snapshot)
+
+
+    def test_out_of_range_values_leave_the_table_intact(self):
+        _id = self.db_manager.insert_row('test_db', 'test_table', ['John', '25', '1.5', '2000.01.02', '2020.01.01-2020.02.01'])
+        row = ['Jane', '30', '2.5', '1995.05.06', '2021.01.01-2021.03.01']
+        with self.assertRaises(TypeError):
+            self.db_manager.insert_rows('test_db', 'test_table', [row, ['Big', str(2 ** 70), '0', '2000.01.01', '2020.01.01-2020.01.02']])
+        table = self.db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual(list(table.rows), [_id])
+
+        with self.assertRaises(OverflowError):
+            table.rows.put('bad', ['Big', 2 ** 70, 0.0, 1, (1, 2)])
+        self.assertEqual({len(column) for column in table.rows.columns}, {1})
+        self.db_manager.insert_row('test_db', 'test_table', row)
+        self.assertEqual(len(table.rows), 2)
+
+
+class TestBinarySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name, snapshot_format='binary')
+        self.rows = [
+            ['John', 25, 1.5, 'J', '2000.01.02', '2020.01.01-2020.02.01'],
+            ['Jane', 30, 2.5, 'ж', '1995.05.06', '2021.01.01-2021.03.01'],
+        ]
+
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
+    def reload(self):
+        db_manager = DbManager(self.tmp_dir.name, snapshot_format='binary')
+        db_manager.load()
+        self.addCleanup(db_manager.close)
+        return db_manager
+
+    def test_round_trip(self):
+        for storage in ('row', 'columnar'):
+            table_name = f'{storage}_table'
+            self.db_manager.create_table(
+                'test_db', table_name, 'name:STRING,age:INT,score:REAL,tag:CHAR,born:DATE,stay:DATEINVL', storage
+            )
+            ids = self.db_manager.insert_rows('test_db', table_name, self.rows)
+            self.db_manager.compact('test_db', table_name)
+            self.assertTrue(os.path.exists(f'{self.tmp_dir.name}/test_db-{table_name}.snap'))
+            self.assertFalse(os.path.exists(f'{self.tmp_dir.name}/test_db-{table_name}.csv'))
+
+            db_manager = self.reload()
+            self.assertEqual(db_manager.get_table_data('test_db', table_name)[2], dict(zip(ids, self.rows)))
+            db_manager.update_row('test_db', table_name, ids[0], ['Jim', 26, 1.5, 'J', '2000.01.02', '2020.01.01-2020.02.01'])
+            self.assertEqual(db_manager.get_table_data('test_db', table_name)[2][ids[1]], self.rows[1])
+
+    def test_csv_export_and_import(self):
+        self.db_manager.create_table('test_db', 'test_table', 'name:STRING,age:INT,score:REAL,tag:CHAR,born:DATE,stay:DATEINVL')
+        ids = self.db_manager.insert_rows('test_db', 'test_table', self.rows)
+        with tempfile.TemporaryDirectory() as export_dir:
+            self.db_manager.export_csv('test_db', 'test_table', f'{export_dir}/export.csv')
+            self.db_manager.import_csv('other_db', 'copy', f'{export_dir}/export.csv', storage='columnar')
+
+        self.assertEqual(self.reload().get_table_data('other_db', 'copy')[2], dict(zip(ids, self.rows)))
+
+
+class TestIndexes(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.create_table('test_db', 'test_table', 'name:STRING,born:DATE', storage='columnar')
+        self.ids = self.db_manager.insert_rows('test_db', 'test_table', [
+            ['John', '2000.01.01'], ['Jane', '1990.06.15'], ['John', '1985.03.03'], ['Jack', '2010.12.31'],
+        ])
+        self.db_manager.create_index('test_db', 'test_table', 'name', 'hash')
+        self.db_manager.create_index('test_db', 'test_table', 'born', 'sorted')
+
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
+    def test_lookups_follow_mutations(self):
+        self.db_manager.update_row('test_db', 'test_table', self.ids[0], ['Jim', '2000.01.01'])
+        self.db_manager.delete_row('test_db', 'test_table', self.ids[1])
+
+        self.assertEqual(list(self.db_manager.lookup_rows('test_db', 'test_table', 'name', 'John')), [self.ids[2]])
+        rows = self.db_manager.range_rows('test_db', 'test_table', 'born', '1980.01.01', '2005.01.01')
+        self.assertEqual(list(rows), [self.ids[2], self.ids[0]])
+        with self.assertRaises(ValueError):
+            self.db_manager.range_rows('test_db', 'test_table', 'name', 'A', 'K')
+
+    def test_indexes_survive_reload(self):
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load()
+        self.addCleanup(db_manager.close)
+        table = db_manager.databases['test_db'].tables['test_table']
+        self.assertEqual({column: index.kind for column, index in table.indexes.items()}, {'name': 'hash', 'born': 'sorted'})
+        self.assertEqual(table.range_lookup('born', high='1990.06.15', include_high=False), [self.ids[2]])
+
+
+    def test_lazy_load_restores_indexes_and_dedup(self):
+        self.db_manager.set_dedup('test_db', 'test_table', 'reject')
+        db_manager = DbManager(self.tmp_dir.name)
+        db_manager.load('lazy')
+        self.addCleanup(db_manager.close)
+        self.assertEqual(list(db_manager.lookup_rows('test_db', 'test_table', 'name', 'Jane')), [self.ids[1]])
+        with self.assertRaises(ValueError):
+            db_manager.insert_row('test_db', 'test_table', ['John', '2000.01.01'])
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_manager = DbManager(self.tmp_dir.name)
+        self.db_manager.databases['test_db'] = Database('test_db')
+        fields = [Field('name', Type.STRING), Field('age', Type.INT), Field('stay', Type.DATEINVL)]
+        self.db_manager.databases['test_db'].create_table('test_table', Schema(fields))
+        self.table = self.db_manager.databases['test_db'].tables['test_table']
+        self.ids = self.table.insert_rows([
+            ['John', 25, '2020.01.01-2020.02.01'],
+            ['Jane', 30, '2020.03.01-2020.04.01'],
+            ['Jack', 35, '2020.01.15-2020.03.15'],
+            ['Jill', 40, '2021.01.01-2021.02.01'],
+        ])
+
+    def tearDown(self):
+        self.db_manager.close()
+        self.tmp_dir.cleanup()
+
+    def test_filter_project_sort_limit(self):
+        columns, rows = self.db_manager.query('test_db', 'test_table', {
+            "columns": ["name"],
+            "where": {"or": [{"column": "age", "op": ">=", "value": "35"}, {"column": "name", "op": "=", "value": "John"}]},
+            "order_by": [["age", "desc"]],
+            "limit": 2,
+        })
+        self.assertEqual(columns, ['id', 'name'])
+        self.assertEqual(rows, [[self.ids[3], 'Jill'], [self.ids[2], 'Jack']])
+
+    def test_interval_predicates_with_index(self):
+        self.table.create_index('age', 'sorted')
+        _, rows = self.db_manager.query('test_db', 'test_table', {
+            "columns": ["stay"],
+            "where": {"and": [
+                {"column": "age", "op": "between", "value": [20, 36]},
+                {"column": "stay", "op": "contains", "value": "2020.01.20"},
+            ]},
+            "order_by": ["name"],
+        })
+        self.assertEqual(rows, [
+            [self.ids[2], '2020.01.15-2020.03.15'],
+            [self.ids[0], '2020.01.01-2020.02.01'],
+        ])
+
+
+class TestSocketProtocol(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.server = DbServer()
+        self.server.dbm = DbManager(self.tmp_dir.name)
+        self.server.dbm.create_table('test_db', 'test_table', 'name:STRING,age:INT')
+
+        self.server_threads = []
+        self.client = DbClient(pool_size=2)
+        self.client.pool.connect = self.connect
+
+    def connect(self):
+        server_socket, client_socket = socket.socketpair()
+        server_thread = threading.Thread(target=self.server.handle_client, args=(server_socket,))
+        server_thread.start()
+        self.server_threads.append(server_thread)
+        return client_socket
+
+    def tearDown(self):
+        self.client.close()
+        for server_thread in self.server_threads:
+            server_thread.join()
+        self.server.dbm.close()
+        self.tmp_dir.cleanup()
+
+    def test_large_table_round_trip(self):
+        rows = [[f'name-{i}' * 10, i] for i in range(5000)]
+        ids = self.client.insert_rows('test_db', 'test_table', rows)['ids']
+
+        types, columns, table_rows = self.client.get_table_data('test_db', 'test_table')
+        self.assertEqual(columns, ['id', 'name', 'age'])
+        self.assertEqual(list(table_rows), ids)
+        self.assertEqual(table_rows[ids[-1]], rows[-1])
+
+    def test_binary_encoding(self):
+        self.server.dbm.create_table('test_db', 'typed_table', 'name:STRING,age:INT,score:REAL,born:DATE,stay:DATEINVL')
+        rows = [[f'name-{i}', i * 1000, i / 4, '1990.01.02', '2020.01.01-2020.02.01'] for i in range(2500)]
+        rows.append(['Ünïcode', -5, 0.0, '2000.12.31', '1999.01.01-2000.01.01'])
+        ids = self.client.insert_rows('test_db', 'typed_table', rows)['ids']
+
+        client = DbClient(pool_size=1, encoding='binary')
+        client.pool.connect = lambda: client._handshake(self.connect())
+        types, columns, table_rows = client.get_table_data('test_db', 'typed_table')
+        born = client.query('test_db', 'typed_table', ['born'], limit=1)[1]
+        client.close()
+        self.assertEqual(table_rows, dict(zip(ids, rows)))
+        self.assertEqual(born, [[ids[0], '1990.01.02']])
+
+    def test_cached_replies(self):
+        ids = self.client.insert_rows('test_db', 'test_table', [['Alice', 30], ['Bob', 25]])['ids']
+
+        first = self.client.get_table_data('test_db', 'test_table')
+        with mock.patch.object(self.server.dbm, 'iter_table_page') as iter_table_page:
+            second = self.client.get_table_data('test_db', 'test_table')
+        iter_table_page.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.cache.hits, 1)
+
+        self.client.update_row('test_db', 'test_table', ids[0], ['Alice', 31])
+        table_rows = self.client.get_table_data('test_db', 'test_table')[2]
+        self.assertEqual(table_rows[ids[0]], ['Alice', 31])
+        self.assertEqual(self.server.cache.hits, 1)
+
+    def test_change_feed(self):
+        self.server.dbm.create_table('test_db', 'other_table', 'name:STRING')
+        with mock.patch('server.FEED_POLL_INTERVAL', 0.05), self.client.subscribe('test_db', 'test_table') as changes:
+            events = iter(changes)
+            _id = self.client.insert_rows('test_db', 'test_table', [['Alice', 30]])['ids'][0]
+            self.client.insert_row('test_db', 'other_table', ['Bob'])
+            self.client.update_row('test_db', 'test_table', _id, ['Alice', 31])
+            self.client.delete_row('test_db', 'test_table', _id)
+            received = [next(events) for _ in range(3)]
+        self.assertEqual([event["changes"] for event in received], [
+            [['I', _id, ['Alice', 30]]], [['U', _id, ['Alice', 31]]], [['D', _id, []]],
+        ])
+        self.assertEqual(received[-1]["version"], self.server.dbm.table_version('test_db', 'test_table'))
+
+    def test_metrics_and_slow_log(self):
+        slow = []
+        self.server.metrics = Metrics(slow_threshold=0, slow_log=slow.append)
+        self.client.insert_rows('test_db', 'test_table', [['Alice', 30], ['Bob', 25]])
+        self.client.get_table_data('test_db', 'test_table')
+        self.client._request({"action": "no_such_action", "data": {}})
+
+        metrics = self.client.stats()
+        self.assertIn('db_requests_total{server="socket",action="insert_rows"} 1', metrics)
+        self.assertIn('db_rows_total{server="socket",action="get_table_data"} 2', metrics)
+        self.assertIn('db_request_errors_total{server="socket",action="unknown"} 1', metrics)
+        self.assertIn('db_active_connections{server="socket"} 1', metrics)
+        self.assertIn('db_phase_duration_seconds_count{phase="serialize"}', metrics)
+        self.assertIn('Slow socket insert_rows on test_db-test_table', slow[0])
+        self.assertTrue(slow[0].endswith('2 rows'))
+
+    def test_compression(self):
+        rows = [['the same text over and over', i] for i in range(3000)]
+        ids = self.client.insert_rows('test_db', 'test_table', rows)['ids']
+
+        client = DbClient(pool_size=1, compression={"level": 6, "threshold": 512})
+        client.pool.connect = lambda: client._handshake(self.connect())
+        with mock.patch('db_protocol.zlib.decompress', wraps=zlib.decompress) as decompress:
+            table_rows = client.get_table_data('test_db', 'test_table')[2]
+            databases = client.fetch_databases_and_tables()
+        client.close()
+        self.assertEqual(table_rows, dict(zip(ids, rows)))
+        self.assertEqual(databases, {'test_db': ['test_table']})
+        self.assertEqual(decompress.call_count, 3)
+
+    def test_pool_shared_by_threads(self):
+        def write(n):
+            for i in range(20):
+                self.client.insert_row('test_db', 'test_table', [f'name-{n}', i])
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(len(self.server_threads), 2)
+
+        # The server drops the connection after an error reply.
+        self.assertIn("error", self.client.delete_row('test_db', 'test_table', 'missing'))
+        self.client.pool.health_check_interval = 0
+        self.assertEqual(self.client.ping(), {"status": "ok"})
+        self.assertEqual(len(self.client.get_table_data('test_db', 'test_table')[2]), 80)
+
+
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.server = AsyncDbServer(max_connections=1, workers=2)
+        self.server.dbm = DbManager(self.tmp_dir.name)
+        self.server.dbm.create_table('test_db', 'test_table', 'name:STRING,age:INT')
+
+    def tearDown(self):
+        self.server.executor.shutdown()
+        self.server.dbm.close()
+        self.tmp_dir.cleanup()
+
+    def test_pipelined_requests(self):
+        async def scenario():
+            listener = await asyncio.start_server(self.server.handle_connection, '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for i in range(3):
+                data = {"db_name": "test_db", "table_name": "test_table", "rows": [[f'name-{i}', i]]}
+                writer.write(encode_message({"id": i, "action": "insert_rows", "data": data}))
+            writer.write(encode_message({"id": "bad", "action": "delete_row", "data": {
+                "db_name": "test_db", "table_name": "test_table", "_id": "missing"}}))
+            await writer.drain()
+            replies = {}
+            for _ in range(4):
+                reply = await read_message(reader)
+                replies[reply["id"]] = reply
+
+            extra_reader, extra_writer = await asyncio.open_connection('127.0.0.1', port)
+            refused = await read_message(extra_reader)
+            extra_writer.close()
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            return replies, refused
+
+        replies, refused = asyncio.run(scenario())
+        self.assertEqual(sorted(replies, key=str), [0, 1, 2, 'bad'])
+        self.assertIn("error", replies["bad"])
+        self.assertEqual(len(self.server.dbm.get_table_data('test_db', 'test_table')[2]), 3)
+        self.assertEqual(refused, {"error": "Too many connections"})
+
+    def test_async_client(self):
+        self.server.max_connections = 2
+
+        async def scenario():
+            listener = await asyncio.start_server(self.server.handle_connection, '127.0.0.1', 0)
+            client = AsyncDbClient(port=listener.sockets[0].getsockname()[1], connections=2, encoding='binary')
+            replies = await asyncio.gather(*(
+                client.insert_rows('test_db', 'test_table', [[f'name-{i}', i]]) for i in range(20)
+            ))
+            page = await client.get_table_page('test_db', 'test_table', limit=5)
+            await client.close()
+            listener.close()
+            await listener.wait_closed()
+            return replies, page
+
+        replies, page = asyncio.run(scenario())
+        self.assertEqual(len({reply["ids"][0] for reply in replies}), 20)
+        self.assertEqual(len(page[2]), 5)
+        self.assertIsNotNone(page[3])
+
+
+@unittest.skipUnless(db_api, "fastapi is not installed")
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dbm = DbManager(self.tmp_dir.name)
+        self.dbm.create_table('test_db', 'test_table', 'name:STRING,age:INT')
+        patcher = mock.patch.object(db_api, 'db_manager', self.dbm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Not entered as a context manager, so the startup load does not run.
+        self.client = TestClient(db_api.app)
+        self.params = {"db_name": "test_db", "table_name": "test_table"}
+
+    def tearDown(self):
+        self.dbm.close()
+        self.tmp_dir.cleanup()
+
+    def test_etag_and_not_modified(self):
+        self.dbm.insert_row('test_db', 'test_table', ['John', 25])
+        response = self.client.get('/table_data', params=self.params)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["etag"]
+
+        response = self.client.get('/table_data', params=self.params, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], etag)
+
+        # A write bumps the version, so the old tag no longer matches.
+        self.dbm.insert_row('test_db', 'test_table', ['Jane', 30])
+        response = self.client.get('/table_data', params=self.params, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+
+    def test_ndjson_stream(self):
+        ids = [self.dbm.insert_row('test_db', 'test_table', [f'name-{i}', i]) for i in range(3)]
+        response = self.client.get('/table_data', params={**self.params, "stream": True, "limit": 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+        lines = response.text.splitlines()
+        header = json.loads(lines[0])
+        self.assertEqual(header["columns"], ['id', 'name', 'age'])
+        self.assertIsNotNone(header["cursor"])
+        self.assertEqual([json.loads(line) for line in lines[1:]], [[ids[0], 'name-0', 0], [ids[1], 'name-1', 1]])
+
+    def test_bad_batch(self):
+        rows = [['John', 25], ['Jane', 'old'], ['Jim', 'older']]
+        response = self.client.post('/insert_rows', json={**self.params, "rows": rows})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error[0] for error in response.json()["detail"]["errors"]], [1, 2])
+        self.assertEqual(len(self.dbm.databases['test_db'].tables['test_table'].rows), 0)
+
+    def test_gzip(self):
+        self.dbm.insert_rows('test_db', 'test_table', [[f'name-{i}', i] for i in range(200)])
+        response = self.client.get('/table_data', params=self.params, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers.get("content-encoding"), "gzip")
+        self.assertEqual(len(response.json()["rows"]), 200)
+
+        response = self.client.get('/table_data', params=self.params, headers={"Accept-Encoding": "identity"})
+        self.assertIsNone(response.headers.get("content-encoding"))
+
+    def test_metrics(self):
+        self.client.get('/table_data', params=self.params)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        self.assertIn('# TYPE db_request_duration_seconds histogram', response.text)
+        self.assertIn('db_requests_total{server="http",action="/table_data"}', response.text)
+
 
 if __name__ == '__main__':
     unittest.main()
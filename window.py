@@ -1,30 +1,188 @@
-import time
+import queue
 import tkinter as tk
 from tkinter import ttk, messagebox
+from concurrent.futures import ThreadPoolExecutor
 from db_manager import DbManager
 from client import DbClient
 
 
+# The table view only ever holds WINDOW_PAGES pages of PAGE_ROWS rows. Pages
+# are fetched as the view is scrolled towards either end of the window and
+# the page at the other end is dropped, so a table of any size costs the
+# same to show.
+PAGE_ROWS = 200
+WINDOW_PAGES = 3
+POLL_MS = 20
+
+# Every database call runs on one worker thread, in the order it was made,
+# so the Tk loop never waits on the disk or the network. Callbacks with the
+# results are queued back and run by process_results on the Tk loop.
+worker = ThreadPoolExecutor(max_workers=1)
+results = queue.Queue()
+
+dbm = None
+selected_db_name = None
+selected_table_name = None
+# Bumped whenever another table is shown, so pages still in flight for the
+# previous one are ignored.
+generation = 0
+window_first = 0
+window_pages: list[list[str]] = []
+has_more = False
+loading = False
+
+
+def in_background(work, on_done=None, error_message="Error", on_error=None):
+    def run():
+        try:
+            result = work()
+            # In client mode a failed request comes back as an error reply
+            # rather than an exception.
+            if isinstance(result, dict) and "error" in result:
+                raise ValueError(result["error"])
+        except Exception as e:
+            message = f"{error_message}: {str(e)}"
+            results.put(lambda: messagebox.showerror("Database Error", message))
+            if on_error is not None:
+                results.put(on_error)
+            return
+        if on_done is not None:
+            results.put(lambda: on_done(result))
+    worker.submit(run)
+
+
+def process_results():
+    root.after(POLL_MS, process_results)
+    while True:
+        try:
+            callback = results.get_nowait()
+        except queue.Empty:
+            return
+        callback()
+
+
+def fetch_page(db_name, table_name, page):
+    result = dbm.get_table_page(db_name, table_name, page * PAGE_ROWS, PAGE_ROWS)
+    if result is None:
+        raise ValueError(f"Table {table_name} does not exist.")
+    return result
+
+
 def load_table_data(db_name, table_name):
-    global dbm, selected_db_name, selected_table_name, main_table
+    global selected_db_name, selected_table_name, generation, loading
     selected_db_name = db_name
     selected_table_name = table_name
+    generation += 1
+    loading = True
+    current = generation
+    in_background(
+        lambda: fetch_page(db_name, table_name, 0),
+        lambda page: show_table(current, page),
+        f"Error loading data from {table_name}",
+        lambda: page_failed(current),
+    )
+
+
+def show_table(current, page):
+    global window_first, window_pages, has_more, loading
+    if current != generation:
+        return
+    _, columns, rows, _ = page
+    clear_main_table()
+    main_table["columns"] = columns
+    main_table["show"] = "headings"
+    for col in main_table["columns"]:
+        main_table.heading(col, text=col)
+        main_table.column(col, anchor="center", width=100)
+    window_first = 0
+    window_pages = [insert_rows(rows, "end")]
+    has_more = len(rows) == PAGE_ROWS
+    loading = False
+
+    create_add_fields()
+
+
+def insert_rows(rows, index):
+    # Rows use their id as the item id, so edits find them directly. A row
+    # that moved between pages while they were fetched is only shown once.
+    keys = []
+    for key, row in rows.items():
+        if not main_table.exists(key):
+            main_table.insert("", index if index == "end" else index + len(keys), iid=key, values=[key] + row)
+            keys.append(key)
+    return keys
+
+
+def on_table_scroll(first, last):
+    scrollbar.set(first, last)
+    if loading or not selected_table_name:
+        return
+    if float(last) > 0.95 and has_more:
+        fetch_window_page(window_first + len(window_pages), append_page)
+    elif float(first) < 0.05 and window_first > 0:
+        fetch_window_page(window_first - 1, prepend_page)
+
+
+def fetch_window_page(page, on_page):
+    global loading
+    loading = True
+    current, db_name, table_name = generation, selected_db_name, selected_table_name
+    in_background(
+        lambda: fetch_page(db_name, table_name, page),
+        lambda result: on_page(current, result[2]),
+        f"Error loading data from {table_name}",
+        lambda: page_failed(current),
+    )
+
+
+def page_failed(current):
+    # Scrolling fetches pages again once a failed one is out of the way.
+    global loading
+    if current == generation:
+        loading = False
+
+
+def append_page(current, rows):
+    global window_first, has_more, loading
+    if current != generation:
+        return
+    loading = False
+    has_more = len(rows) == PAGE_ROWS
+    if not rows:
+        return
+    window_pages.append(insert_rows(rows, "end"))
+    if len(window_pages) > WINDOW_PAGES:
+        drop_rows(window_pages.pop(0), above=True)
+        window_first += 1
+
+
+def prepend_page(current, rows):
+    global window_first, has_more, loading
+    if current != generation:
+        return
+    keys = insert_rows(rows, 0)
+    window_pages.insert(0, keys)
+    keep_view(len(keys))
+    window_first -= 1
+    if len(window_pages) > WINDOW_PAGES:
+        drop_rows(window_pages.pop(), above=False)
+        has_more = True
+    loading = False
+
 
-    try:
-        _, columns, rows = dbm.get_table_data(db_name, table_name)
-        main_table.delete(*main_table.get_children())
-        main_table["columns"] = columns
-        main_table["show"] = "headings"
-        for col in main_table["columns"]:
-            main_table.heading(col, text=col)
-            main_table.column(col, anchor="center", width=100)
-        for key, row in rows.items():
-            main_table.insert("", "end", values=[key] + row)
+def drop_rows(keys, above):
+    main_table.delete(*[key for key in keys if main_table.exists(key)])
+    if above:
+        keep_view(-len(keys))
 
-        create_add_fields()
 
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error loading data from {table_name}: {str(e)}")
+def keep_view(shift):
+    # Rows added or removed above the view would otherwise move the rows
+    # the user is looking at.
+    total = len(main_table.get_children())
+    if total:
+        top = main_table.yview()[0] * (total - shift)
+        main_table.yview_moveto((top + shift) / total)
 
 
 def clear_main_table():
@@ -77,19 +235,18 @@ def on_table_select(event):
 
 def save_changes():
     updated_values = [entry.get() for entry in entries]
-    try:
-        dbm.update_row(
-            selected_db_name,
-            selected_table_name,
-            main_table.item(main_table.selection()[0])["values"][0],
-            updated_values,
-        )
-        load_table_data(selected_db_name, selected_table_name)
+    db_name, table_name, _id = selected_db_name, selected_table_name, main_table.selection()[0]
+    in_background(
+        lambda: dbm.update_row(db_name, table_name, _id, updated_values),
+        lambda _: row_updated(_id, updated_values),
+        "Error updating record",
+    )
 
-        messagebox.showinfo("Success", "Record updated successfully!")
 
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error updating record: {str(e)}")
+def row_updated(_id, values):
+    if main_table.exists(_id):
+        main_table.item(_id, values=[_id] + values)
+    messagebox.showinfo("Success", "Record updated successfully!")
 
 
 def add_record():
@@ -99,12 +256,22 @@ def add_record():
         messagebox.showerror("Input Error", "Please fill in all fields before adding a record.")
         return
 
-    try:
-        dbm.insert_row(selected_db_name, selected_table_name, new_values)
-        load_table_data(selected_db_name, selected_table_name)
-        messagebox.showinfo("Success", "Record added successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error adding record: {str(e)}")
+    db_name, table_name, current = selected_db_name, selected_table_name, generation
+    in_background(
+        lambda: dbm.insert_row(db_name, table_name, new_values),
+        lambda result: row_added(current, result, new_values),
+        "Error adding record",
+    )
+
+
+def row_added(current, result, values):
+    # The manager returns the new id, the client the server's reply. New
+    # rows go to the end of the table, so they are only shown if the view
+    # already reaches it.
+    _id = result["_id"] if isinstance(result, dict) else result
+    if current == generation and not has_more and window_pages:
+        window_pages[-1].extend(insert_rows({_id: values}, "end"))
+    messagebox.showinfo("Success", "Record added successfully!")
 
 
 def delete_record():
@@ -113,15 +280,21 @@ def delete_record():
         messagebox.showerror("Error", "Please select a record to delete.")
         return
 
-    item = main_table.item(selected_item[0])
-    primary_key_value = item['values'][0]
+    db_name, table_name, primary_key_value = selected_db_name, selected_table_name, selected_item[0]
+    in_background(
+        lambda: dbm.delete_row(db_name, table_name, primary_key_value),
+        lambda _: row_deleted(primary_key_value),
+        "Error deleting record",
+    )
 
-    try:
-        dbm.delete_row(selected_db_name, selected_table_name, primary_key_value)        
-        load_table_data(selected_db_name, selected_table_name)
-        messagebox.showinfo("Success", "Record deleted successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error deleting record: {str(e)}")
+
+def row_deleted(_id):
+    if main_table.exists(_id):
+        main_table.delete(_id)
+    for keys in window_pages:
+        if _id in keys:
+            keys.remove(_id)
+    messagebox.showinfo("Success", "Record deleted successfully!")
 
 
 def create_add_fields():
@@ -146,13 +319,13 @@ def create_database():
         messagebox.showerror("Input Error", "Please enter a name for the new database.")
         return
 
-    try:
-        dbm.create_database(db_name)
-        tree.insert("", "end", text=db_name, open=True)
-        new_db_entry.delete(0, 'end')
-        messagebox.showinfo("Success", f"Database '{db_name}' created successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error creating database: {str(e)}")
+    in_background(lambda: dbm.create_database(db_name), lambda _: database_created(db_name), "Error creating database")
+
+
+def database_created(db_name):
+    tree.insert("", "end", text=db_name, open=True)
+    new_db_entry.delete(0, 'end')
+    messagebox.showinfo("Success", f"Database '{db_name}' created successfully!")
 
 def create_table():
     table_name = new_table_entry.get()
@@ -166,23 +339,27 @@ def create_table():
         messagebox.showerror("Input Error", "Please enter both table name and column definitions.")
         return
 
-    try:
-        dbm.create_table(selected_db_name, table_name, column_definitions)
-        parent_item = None
-        for item in tree.get_children():
-            if tree.item(item, "text") == selected_db_name:
-                parent_item = item
-                break
-        if parent_item:
-            tree.insert(parent_item, "end", text=table_name)
-        new_table_entry.delete(0, 'end')
-        new_table_columns_entry.delete(0, 'end')
-        messagebox.showinfo("Success", f"Table '{table_name}' created successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error creating table: {str(e)}")
+    db_name = selected_db_name
+    in_background(
+        lambda: dbm.create_table(db_name, table_name, column_definitions),
+        lambda _: table_created(db_name, table_name),
+        "Error creating table",
+    )
+
+
+def table_created(db_name, table_name):
+    parent_item = None
+    for item in tree.get_children():
+        if tree.item(item, "text") == db_name:
+            parent_item = item
+            break
+    if parent_item:
+        tree.insert(parent_item, "end", text=table_name)
+    new_table_entry.delete(0, 'end')
+    new_table_columns_entry.delete(0, 'end')
+    messagebox.showinfo("Success", f"Table '{table_name}' created successfully!")
 
 def delete_database():
-    global selected_db_name
     if not selected_db_name:
         messagebox.showerror("Selection Error", "Please select a database to delete.")
         return
@@ -191,17 +368,19 @@ def delete_database():
     if not confirm:
         return
 
-    try:
-        dbm.drop_database(selected_db_name)
-        for item in tree.get_children():
-            if tree.item(item, "text") == selected_db_name:
-                tree.delete(item)
-                break
-        clear_main_table()
-        selected_db_name = None
-        messagebox.showinfo("Success", "Database deleted successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error deleting database: {str(e)}")
+    db_name = selected_db_name
+    in_background(lambda: dbm.drop_database(db_name), lambda _: database_deleted(db_name), "Error deleting database")
+
+
+def database_deleted(db_name):
+    global selected_db_name
+    for item in tree.get_children():
+        if tree.item(item, "text") == db_name:
+            tree.delete(item)
+            break
+    clear_main_table()
+    selected_db_name = None
+    messagebox.showinfo("Success", "Database deleted successfully!")
 
 
 def delete_table():
@@ -224,38 +403,59 @@ def delete_table():
     if not confirm:
         return
 
-    try:
-        dbm.delete_table(db_name, table_name)
-        tree.delete(selected_item[0])
-        clear_main_table()
-        messagebox.showinfo("Success", "Table deleted successfully!")
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error deleting table: {str(e)}")
+    in_background(lambda: dbm.delete_table(db_name, table_name), lambda _: table_deleted(selected_item[0]), "Error deleting table")
+
+
+def table_deleted(item):
+    if tree.exists(item):
+        tree.delete(item)
+    clear_main_table()
+    messagebox.showinfo("Success", "Table deleted successfully!")
 
 
 def delete_duplicate_rows():
     """Delete duplicate rows from the currently selected table."""
-    global dbm, selected_db_name, selected_table_name, main_table
-
     if not selected_db_name or not selected_table_name:
         messagebox.showerror("Error", "Please select a table first.")
         return
 
-    try:
-        deleted_duplicates = dbm.delete_repeated(selected_db_name, selected_table_name)
-        load_table_data(selected_db_name, selected_table_name)
+    db_name, table_name = selected_db_name, selected_table_name
+    in_background(
+        lambda: dbm.delete_repeated(db_name, table_name),
+        lambda deleted: duplicates_deleted(db_name, table_name, deleted),
+        "Error deleting duplicates",
+    )
+
+
+def duplicates_deleted(db_name, table_name, deleted_duplicates):
+    if deleted_duplicates:
+        load_table_data(db_name, table_name)
+        messagebox.showinfo("Success", f"Deleted {deleted_duplicates} duplicate rows.")
+    else:
+        messagebox.showinfo("Info", "No duplicate rows found.")
 
-        if deleted_duplicates:
-            messagebox.showinfo("Success", f"Deleted {deleted_duplicates} duplicate rows.")
-        else:
-            messagebox.showinfo("Info", "No duplicate rows found.")
 
-    except Exception as e:
-        messagebox.showerror("Database Error", f"Error deleting duplicates: {str(e)}")
+def open_database(mode):
+    global dbm
+    match mode:
+        case 'd':
+            dbm = DbManager()
+            dbm.load('lazy')
+        case 'c':
+            dbm = DbClient()
+            dbm.run()
+    return dbm.fetch_databases_and_tables()
+
+
+def show_databases(databases):
+    for db_name, tables in databases.items():
+        db_item = tree.insert("", "end", text=db_name, open=True)
+        for table in tables:
+            tree.insert(db_item, "end", text=table)
 
 
 def run_gui(mode):
-    global dbm, tree, main_table, entries, add_entries, add_record_frame, edit_frame, new_db_entry, new_table_entry, new_table_columns_entry
+    global root, tree, main_table, scrollbar, entries, add_entries, add_record_frame, edit_frame, new_db_entry, new_table_entry, new_table_columns_entry
 
     root = tk.Tk()
     root.title("Database and Table Viewer with Editing")
@@ -304,8 +504,11 @@ def run_gui(mode):
     main_panel = ttk.Frame(root)
     main_panel.pack(side="left", fill="both", expand=True)
 
-    main_table = ttk.Treeview(main_panel)
+    scrollbar = ttk.Scrollbar(main_panel, orient="vertical")
+    scrollbar.pack(side="right", fill="y")
+    main_table = ttk.Treeview(main_panel, yscrollcommand=on_table_scroll)
     main_table.pack(fill="both", expand=True)
+    scrollbar.configure(command=main_table.yview)
 
     edit_frame = ttk.Frame(root)
     edit_frame.pack(side="right", fill="y")
@@ -320,20 +523,10 @@ def run_gui(mode):
 
     create_add_fields()
 
-    match mode:
-        case 'd':
-            dbm = DbManager()
-            dbm.load()
-        case 'c':
-            dbm = DbClient()
-            dbm.run()
-
-    databases = dbm.fetch_databases_and_tables()
-    for db_name, tables in databases.items():
-        db_item = tree.insert("", "end", text=db_name, open=True)
-        for table in tables:
-            tree.insert(db_item, "end", text=table)
+    in_background(lambda: open_database(mode), show_databases, "Error opening the database")
 
     tree.bind("<<TreeviewSelect>>", on_tree_select)
 
+    process_results()
     root.mainloop()
+    worker.shutdown()